@@ -10,6 +10,20 @@
 #   modified to be run in Jupyter notebook. Since only one test PLS file is provided,
 #   program can be executed with the same file for both input parameters.
 #
+#   Parsed GTF annotations are cached as NumPy arrays under ~/.cache/genome_browser
+#   (see -c), so only the first run against a given GTF pays for parsing it.
+#   PSL reads are streamed and filtered to the region while parsing; with -x,
+#   coordinate-sorted PSLs are copied to an indexed blocked gzip (.bgz) so later
+#   runs only decompress the blocks overlapping the region. Read panels whose
+#   reads stack into more rows than the panel shows (or, with -t, that have more
+#   reads in the region than -t) are drawn as a read depth histogram instead.
+#   With -r regions.bed, the GTF and reads are parsed once and every region is
+#   rendered to <output_file>/<name>.png by a pool of -p forked workers;
+#   regions sharing a name are told apart by their coordinates.
+#   With --tiles DIR, fixed-width tiles are rendered for each zoom level in
+#   --tile_widths (the finest shows reads, coarser ones read depth), listed in
+#   DIR/manifest.json, covering the -r regions or otherwise every chromosome.
+#
 #   Program uses the mouse reference genome (vM12) and could be replaced by any 
 #   of the human (HG19 or HG38) genome references. These references can be 
 #   downloaded from the following sites.
@@ -31,12 +45,23 @@
 ################################################################################
 
 # Required modules
+import matplotlib
+matplotlib.use("Agg") # figures are only saved, and forked workers must not touch a GUI
 import matplotlib.pyplot as plt
-import matplotlib.patches as mplpatches
+from matplotlib.collections import PolyCollection
 import matplotlib.image as mpimg
 from operator import itemgetter
+from collections import Counter
+import heapq
 import numpy as np
+import hashlib
+import gzip
+import tempfile
+import shutil
 import sys
+import os
+import multiprocessing
+import json
 import argparse
 
 # Argument parser and definitions
@@ -46,6 +71,21 @@ parser.add_argument("-i2", "--input_file2")
 parser.add_argument("-g", "--genome")
 parser.add_argument("-o", "--output_file")
 parser.add_argument("-s", "--style_sheet") 
+parser.add_argument("-c", "--cache_dir", default=os.path.join(os.path.expanduser("~"), ".cache", "genome_browser"),
+                    help="directory for parsed GTF caches; pass an empty string to disable")
+parser.add_argument("-x", "--index_reads", action="store_true",
+                    help="compress coordinate-sorted PSL inputs into indexed blocked gzip (.bgz) and read those")
+parser.add_argument("-r", "--regions",
+                    help="BED file of regions; renders each region to <output_file>/<name>.png")
+parser.add_argument("-p", "--processes", type=int, default=os.cpu_count() or 1,
+                    help="worker processes used to render --regions")
+parser.add_argument("--tiles",
+                    help="write zoomable map tiles and a manifest.json to this directory instead of figures")
+parser.add_argument("--tile_widths", default="1000000,100000,10000",
+                    help="comma-separated tile widths in bp, one per zoom level; the finest shows reads")
+parser.add_argument("-t", "--coverage_threshold", type=int,
+                    help="draw read depth instead of individual reads above this many reads in the region; "
+                         "by default, when the reads stack into more rows than the panel shows")
 
 # Read style sheet
 args = parser.parse_args()
@@ -57,6 +97,25 @@ readsFile1 = args.input_file1
 readsFile2 = args.input_file2
 genomeFile = args.genome
 outFile = args.output_file
+cacheDir = args.cache_dir
+coverageThreshold = args.coverage_threshold
+regionsFile = args.regions
+processes = args.processes
+tileDir = args.tiles
+tileWidths = [int(width) for width in args.tile_widths.split(',')]
+
+# Tile image size and depth bins per coarse tile
+tileWidthPx = 1024
+tileHeightPx = 512
+tileDpi = 128
+tileBins = 512
+
+# Parsed GTF arrays and block feature types, stored by position in blockTypes
+annotationArrays = ['chromNames', 'chromIds', 'starts', 'ends', 'maxEnds', 'blockOffsets',
+                    'blockStarts', 'blockWidths', 'blockTypes', 'transcriptIds']
+blockTypes = ['exon', 'CDS']
+# Bump when readGtf or the arrays above change, so older caches are not reused
+gtfCacheVersion = 1
 
 # Set panels parameters
 def panel_params(x_pos, y_pos, figureWidth, figureHeight):
@@ -79,25 +138,149 @@ def panel_params(x_pos, y_pos, figureWidth, figureHeight):
 
 	return panel
 
-# Read and parse though pls files
-def readData(inFile):
-	readList = []
-	openFile = open(inFile,'r')
-	for line in openFile:
-		a = line.strip().split('\t')
-		chromosome = a[13]
-		start = int(a[15])
-		end = int(a[16])
-		blockstarts = np.array(a[20].split(',')[:-1],dtype=int)
-		blockwidths = np.array(a[18].split(',')[:-1],dtype=int)
-		read = [chromosome,start,end,blockstarts,blockwidths] 
-		readList.append(read)
-
-	return readList
-
-# Read input GTF file
+# Open a PSL file, plain or gzip/blocked-gzip compressed
+def openReads(inFile):
+	if inFile.endswith('.gz') or inFile.endswith('.bgz'):
+		return gzip.open(inFile, 'rt')
+	return open(inFile, 'r')
+
+# Parse one PSL line into a read record
+def parseRead(line):
+	a = line.rstrip('\n').split('\t')
+	chromosome = a[13]
+	start = int(a[15])
+	end = int(a[16])
+	blockstarts = np.array(a[20].split(',')[:-1],dtype=int)
+	blockwidths = np.array(a[18].split(',')[:-1],dtype=int)
+	return [chromosome,start,end,blockstarts,blockwidths]
+
+# Compress a coordinate-sorted PSL into independent gzip blocks (bgzip-style)
+# and write a per-block index of chromosome, first start, max end and offset
+def indexReads(inFile, blockSize=65536):
+	outFile = (inFile[:-3] if inFile.endswith('.gz') else inFile) + '.bgz'
+	if os.path.exists(outFile+'.idx.npz') and os.path.getmtime(outFile+'.idx.npz') >= os.path.getmtime(inFile):
+		return outFile
+
+	chromNames, chromIds, starts, maxEnds, offsets, sizes = [], [], [], [], [], []
+	block, blockBytes, blockEnd = [], 0, 0
+	prevChromosome, prevStart = None, 0
+	unsorted = False
+	# Write next to the output so an unsorted input never leaves a truncated copy behind
+	tmpFile = outFile+'.tmp'
+	with openReads(inFile) as openFile, open(tmpFile, 'wb') as outBlocks:
+		def writeBlock(block, blockEnd):
+			data = gzip.compress(''.join(block).encode())
+			offsets.append(outBlocks.tell())
+			sizes.append(len(data))
+			maxEnds.append(blockEnd)
+			outBlocks.write(data)
+
+		for line in openFile:
+			a = line.split('\t', 17)
+			chromosome, start, end = a[13], int(a[15]), int(a[16])
+			if chromosome == prevChromosome and start < prevStart:
+				unsorted = True
+				break
+			if chromosome != prevChromosome or blockBytes >= blockSize:
+				# Blocks never span chromosomes
+				if block:
+					writeBlock(block, blockEnd)
+				block, blockBytes, blockEnd = [], 0, 0
+				if chromosome != prevChromosome:
+					if chromosome in chromNames:
+						unsorted = True
+						break
+					chromNames.append(chromosome)
+				chromIds.append(len(chromNames)-1)
+				starts.append(start)
+			block.append(line)
+			blockBytes += len(line)
+			blockEnd = max(blockEnd, end)
+			prevChromosome, prevStart = chromosome, start
+		if block and not unsorted:
+			writeBlock(block, blockEnd)
+	if unsorted:
+		os.remove(tmpFile)
+		raise ValueError("%s is not sorted by chromosome and start (sort -k14,14 -k16,16n)" % inFile)
+	os.replace(tmpFile, outFile)
+
+	np.savez(outFile+'.idx.npz', chromNames=np.array(chromNames, dtype=str),
+			 chromIds=np.array(chromIds, dtype=np.int32), starts=np.array(starts, dtype=np.int64),
+			 maxEnds=np.array(maxEnds, dtype=np.int64), offsets=np.array(offsets, dtype=np.int64),
+			 sizes=np.array(sizes, dtype=np.int64))
+
+	return outFile
+
+# Yield only the lines of indexed blocks that can overlap any of the regions
+def readIndexedLines(inFile, regions):
+	with np.load(inFile+'.idx.npz') as indexFile:
+		index = {name: indexFile[name] for name in indexFile.files}
+	keep = np.zeros(len(index['offsets']), dtype=bool)
+	for genomicCoord in regions:
+		chromIds = np.flatnonzero(index['chromNames'] == genomicCoord[0])
+		if len(chromIds) > 0:
+			keep |= ((index['chromIds'] == chromIds[0]) &
+					 (index['starts'] < genomicCoord[2]) &
+					 (index['maxEnds'] > genomicCoord[1]))
+	with open(inFile, 'rb') as openFile:
+		for block in np.flatnonzero(keep):
+			openFile.seek(index['offsets'][block])
+			data = gzip.decompress(openFile.read(index['sizes'][block]))
+			yield from data.decode().splitlines()
+
+# Stream reads from a PSL file, keeping only those overlapping any of the
+# regions (all reads if regions is None); indexed files are read block-wise
+def readData(inFile, regions=None):
+	if regions is None:
+		with openReads(inFile) as openFile:
+			for line in openFile:
+				yield parseRead(line)
+		return
+
+	regionIndex = buildIndex([list(genomicCoord) for genomicCoord in regions])
+	if os.path.exists(inFile+'.idx.npz'):
+		lines = readIndexedLines(inFile, regions)
+	else:
+		lines = openReads(inFile)
+	try:
+		for line in lines:
+			# Only split as far as the coordinates until the read is known to be kept
+			a = line.split('\t', 17)
+			if queryIndex(regionIndex, a[13], int(a[15]), int(a[16])):
+				yield parseRead(line)
+	finally:
+		lines.close()
+
+# Read BED regions as [chromosome, start, end, name], naming unnamed regions by
+# coordinates. Names are unique, as each names an output file: BED names shared
+# by several regions get their coordinates appended, and repeats a copy number
+def readRegions(inFile):
+	regions = []
+	named = []
+	for line in open(inFile):
+		if line.strip() and not line.startswith(('#', 'track', 'browser')):
+			a = line.strip().split('\t')
+			name = a[3] if len(a) > 3 else '%s_%s_%s' % (a[0], a[1], a[2])
+			regions.append([a[0], int(a[1]), int(a[2]), name.replace(os.sep, '_')])
+			named.append(len(a) > 3)
+
+	nameCounts = Counter(region[3] for region in regions)
+	names = set()
+	for region, isNamed in zip(regions, named):
+		name = region[3]
+		if isNamed and nameCounts[name] > 1:
+			name = '%s_%s_%d_%d' % (name, region[0], region[1], region[2])
+		uniqueName, copy = name, 1
+		while uniqueName in names:
+			copy += 1
+			uniqueName = '%s_%d' % (name, copy)
+		names.add(uniqueName)
+		region[3] = uniqueName
+
+	return regions
+
+# Read input GTF file into columnar arrays sorted by chromosome and start
 def readGtf(inFile):
-    transcriptList = []
     gtfDict = {}
     for line in open(inFile):
         if line[0] != '#':
@@ -112,169 +295,447 @@ def readGtf(inFile):
                     gtfDict[transcript] = []
                 gtfDict[transcript].append([chromosome, start, end, type1])
 
-    for transcript, parts in gtfDict.items():
-        starts = []
-        ends = []
-        blockstarts = []
-        blockwidths = []
-        types = []
+    chromNames = []
+    chromLookup = {}
+    chromIds = np.zeros(len(gtfDict), dtype=np.int32)
+    starts = np.zeros(len(gtfDict), dtype=np.int64)
+    ends = np.zeros(len(gtfDict), dtype=np.int64)
+    blockCounts = np.zeros(len(gtfDict), dtype=np.int64)
+    blockstarts = []
+    blockwidths = []
+    blocktypes = []
+    for index, parts in enumerate(gtfDict.values()):
+        chromosome = parts[-1][0]
+        if chromosome not in chromLookup:
+            chromLookup[chromosome] = len(chromNames)
+            chromNames.append(chromosome)
+        chromIds[index] = chromLookup[chromosome]
+        starts[index] = min(part[1] for part in parts)
+        ends[index] = max(part[2] for part in parts)
+        blockCounts[index] = len(parts)
         for part in parts:
-            starts.append(part[1])
-            ends.append(part[2])
             blockstarts.append(part[1])
             blockwidths.append(part[2]-part[1])
-            chromosome=part[0]
-            types.append(part[3])
-        transcriptList.append([chromosome, min(starts), max(ends), blockstarts, blockwidths, types])
+            blocktypes.append(blockTypes.index(part[3]))
+
+    # Reorder transcripts, keeping each transcript's blocks together
+    order = np.lexsort((starts, chromIds))
+    blockOffsets = np.zeros(len(gtfDict)+1, dtype=np.int64)
+    np.cumsum(blockCounts, out=blockOffsets[1:])
+    sortedOffsets = np.zeros(len(gtfDict)+1, dtype=np.int64)
+    np.cumsum(blockCounts[order], out=sortedOffsets[1:])
+    blockShift = np.repeat(blockOffsets[:-1][order] - sortedOffsets[:-1], blockCounts[order])
+    blockOrder = np.arange(sortedOffsets[-1]) + blockShift
+
+    # Running max of ends restarts on every chromosome
+    maxEnds = ends[order].copy()
+    sortedChromIds = chromIds[order]
+    for chromId in range(len(chromNames)):
+        lo, hi = np.searchsorted(sortedChromIds, [chromId, chromId+1])
+        maxEnds[lo:hi] = np.maximum.accumulate(maxEnds[lo:hi])
+
+    annotation = {
+        'chromNames': np.array(chromNames, dtype=str),
+        'chromIds': sortedChromIds,
+        'starts': starts[order],
+        'ends': ends[order],
+        'maxEnds': maxEnds,
+        'blockOffsets': sortedOffsets,
+        'blockStarts': np.array(blockstarts, dtype=np.int64)[blockOrder],
+        'blockWidths': np.array(blockwidths, dtype=np.int64)[blockOrder],
+        'blockTypes': np.array(blocktypes, dtype=np.int8)[blockOrder],
+        'transcriptIds': np.array([transcript.encode() for transcript in gtfDict], dtype=bytes)[order],
+    }
+
+    return annotation
+
+# Cache directory for a GTF, keyed by the cache format version and the GTF's
+# path, size and modification time
+def gtfCachePath(inFile, cacheDir):
+    stat = os.stat(inFile)
+    key = '%d\t%s\t%d\t%d' % (gtfCacheVersion, os.path.abspath(inFile), stat.st_size, stat.st_mtime_ns)
+    return os.path.join(cacheDir, hashlib.sha1(key.encode()).hexdigest())
+
+# Load parsed GTF arrays from the cache, parsing and writing the cache on a miss
+def loadGtf(inFile, cacheDir):
+    if not cacheDir:
+        return readGtf(inFile)
+    cachePath = gtfCachePath(inFile, cacheDir)
+    if os.path.isdir(cachePath):
+        return {name: np.load(os.path.join(cachePath, name+'.npy'), mmap_mode='r') for name in annotationArrays}
+
+    annotation = readGtf(inFile)
+    # Write into a scratch directory first so a crashed run never leaves a partial cache
+    os.makedirs(cacheDir, exist_ok=True)
+    tmpPath = tempfile.mkdtemp(dir=cacheDir)
+    for name in annotationArrays:
+        np.save(os.path.join(tmpPath, name+'.npy'), annotation[name])
+    try:
+        os.rename(tmpPath, cachePath)
+    except OSError:
+        shutil.rmtree(tmpPath) # another run finished the same cache first
+
+    return annotation
+
+# Return positions in a start-sorted track that overlap start-end
+def overlapRange(starts, maxEnds, ends, start, end):
+    # maxEnds is non-decreasing, so everything before first ends before the region
+    first = np.searchsorted(maxEnds, start, side='right')
+    last = np.searchsorted(starts, end, side='left')
+    return first + np.flatnonzero(ends[first:last] > start)
+
+# Build per-chromosome overlap index: records sorted by start plus running max of ends
+def buildIndex(recordList):
+    chromDict = {}
+    for record in recordList:
+        chromosome = record[0]
+        if chromosome not in chromDict:
+            chromDict[chromosome] = []
+        chromDict[chromosome].append(record)
+
+    index = {}
+    for chromosome, records in chromDict.items():
+        records.sort(key=itemgetter(1))
+        starts = np.array([record[1] for record in records], dtype=np.int64)
+        ends = np.array([record[2] for record in records], dtype=np.int64)
+        index[chromosome] = (starts, np.maximum.accumulate(ends), ends, records)
+
+    return index
+
+# Return indexed records overlapping chromosome:start-end
+def queryIndex(index, chromosome, start, end):
+    if chromosome not in index:
+        return []
+    starts, maxEnds, ends, records = index[chromosome]
+    return [records[i] for i in overlapRange(starts, maxEnds, ends, start, end)]
+
+# Return annotated transcripts overlapping chromosome:start-end as
+# [chromosome, start, end, blockstarts, blockwidths, types] records
+def queryAnnotation(annotation, chromosome, start, end):
+    chromIds = np.flatnonzero(annotation['chromNames'] == chromosome)
+    if len(chromIds) == 0:
+        return []
+    lo, hi = np.searchsorted(annotation['chromIds'], [chromIds[0], chromIds[0]+1])
+    hits = lo + overlapRange(annotation['starts'][lo:hi], annotation['maxEnds'][lo:hi],
+                             annotation['ends'][lo:hi], start, end)
+
+    transcriptList = []
+    for i in hits:
+        blockLo, blockHi = annotation['blockOffsets'][i], annotation['blockOffsets'][i+1]
+        types = [blockTypes[t] for t in annotation['blockTypes'][blockLo:blockHi]]
+        transcriptList.append([chromosome, int(annotation['starts'][i]), int(annotation['ends'][i]),
+                               np.array(annotation['blockStarts'][blockLo:blockHi]),
+                               np.array(annotation['blockWidths'][blockLo:blockHi]), types])
 
     return transcriptList
 
+# Greedy interval packing: give each interval, in start order, the lowest row
+# whose previous interval has ended; returns 1-based rows in input order
+def packRows(starts, ends):
+    rows = np.zeros(len(starts), dtype=int)
+    rowEnds = [] # heap of (end, row) for occupied rows
+    freeRows = [] # heap of rows whose last interval has ended
+    nextRow = 1
+    for i in np.argsort(starts, kind='stable'):
+        while rowEnds and rowEnds[0][0] < starts[i]:
+            heapq.heappush(freeRows, heapq.heappop(rowEnds)[1])
+        if freeRows:
+            row = heapq.heappop(freeRows)
+        else:
+            row = nextRow
+            nextRow += 1
+        heapq.heappush(rowEnds, (ends[i], row))
+        rows[i] = row
+
+    return rows
+
+# Draw rectangles given as coordinate arrays as a single collection
+def addRectangles(panel, x, y, widths, heights, color):
+    x = np.asarray(x, dtype=float)
+    y = np.broadcast_to(np.asarray(y, dtype=float), x.shape)
+    right = x + widths
+    top = y + heights
+    verts = np.stack([np.stack([x, y], axis=-1), np.stack([right, y], axis=-1),
+                      np.stack([right, top], axis=-1), np.stack([x, top], axis=-1)], axis=1)
+    rects = PolyCollection(verts, facecolors=color, edgecolors=color, linewidths=0)
+    panel.add_collection(rects, autolim=False)
+
 # Plot transcripts
-def plotTranscripts(panel, readList, genomicCoord, line_thin, line_thick, width, color):
+def plotTranscripts(panel, annotation, genomicCoord, line_thin, line_thick, width, color):
     genome_chromosome, genome_start, genome_end = genomicCoord[0], genomicCoord[1], genomicCoord[2]
     plottedReads = [] # Keep list of plotted reads
-    for read in readList:
-        chromosome, start, end, blockstarts, blockwidths, type1 = read[0], read[1], read[2], read[3], read[4], read[5]
-        if chromosome == genome_chromosome:
-            if genome_start < start < genome_end or genome_start < end < genome_end:
-            	# Keep track of plotted reads
-            	new_read = [read[0], read[1], read[2], read[3], read[4], False, read[5]]
-            	plottedReads.append(new_read)
-    
-    # Sort plotted reads based on start position
-    sortedPlottedReads = sorted(plottedReads, key=itemgetter(2))
-
-    # Make y position go up after every iteration
-    for y_pos in range(1, len(sortedPlottedReads), 1):
-    	lastPlottedEnd = genome_start-100000
-    	for read in sortedPlottedReads:
-    		chromosome, start, end, blockstarts, blockwidths, plotted, type1 = read[0], read[1], read[2], read[3], read[4], read[5], read[6]
-    		if plotted is False:
-    			if start > lastPlottedEnd:
-    				rect = mplpatches.Rectangle((start, y_pos+width),
-    											end-start,
-    											line_thin,
-    											facecolor=color, 
-    											edgecolor=color, 
-    											linewidth=0)
-    				panel.add_patch(rect)
-    				for index in np.arange(0, len(blockstarts), 1):
-    					blockstart = blockstarts[index]
-    					blockwidth = blockwidths[index]
-    					element =  type1[index]
-    					if element == "exon":
-    						rect1 = mplpatches.Rectangle((blockstart, y_pos+0.12),
-    												blockwidth,
-    												line_thick,
-    												facecolor=color, 
-    												edgecolor=color,
-    												linewidth=0)
-    						panel.add_patch(rect1)
-    					if element == "CDS":
-    						line_thickness = 0.5
-    						rect2 = mplpatches.Rectangle((blockstart, y_pos-0.01),
-    												blockwidth,
-    												line_thickness,
-    												facecolor=color, 
-    												edgecolor=color,
-    												linewidth=0)
-    						panel.add_patch(rect2)
-
-    				read[5] = True
-    				lastPlottedEnd = end
-
-    return y_pos
-
-# Plot reads
-def plotReads(panel, readList, genomicCoord, line_thin, line_thick, width, color):
+    for read in queryAnnotation(annotation, genome_chromosome, genome_start, genome_end):
+        chromosome, start, end = read[0], read[1], read[2]
+        if genome_start < start < genome_end or genome_start < end < genome_end:
+            plottedReads.append(read)
+    if not plottedReads:
+        return 0
+
+    # Stack overlapping transcripts on separate rows
+    starts = np.array([read[1] for read in plottedReads])
+    ends = np.array([read[2] for read in plottedReads])
+    rows = packRows(starts, ends)
+    addRectangles(panel, starts, rows+width, ends-starts, line_thin, color)
+
+    # Exon and CDS blocks, one collection each
+    blockRows = np.repeat(rows, [len(read[3]) for read in plottedReads])
+    blockstarts = np.concatenate([read[3] for read in plottedReads])
+    blockwidths = np.concatenate([read[4] for read in plottedReads])
+    type1 = np.concatenate([read[5] for read in plottedReads])
+    exons = type1 == "exon"
+    addRectangles(panel, blockstarts[exons], blockRows[exons]+0.12, blockwidths[exons], line_thick, color)
+    cds = type1 == "CDS"
+    line_thickness = 0.5
+    addRectangles(panel, blockstarts[cds], blockRows[cds]-0.01, blockwidths[cds], line_thickness, color)
+
+    return rows.max()
+
+# Select the reads to plot and stack overlapping ones on separate rows
+def stackReads(readList, genomicCoord):
 	genome_chromosome, genome_start, genome_end = genomicCoord[0], genomicCoord[1], genomicCoord[2]
 	plottedReads = [] # Keep list of plotted reads
 	for read in readList: 
-		chromosome, start, end, blockstarts, blockwidths, = read[0], read[1], read[2], read[3], read[4]
+		chromosome, start, end = read[0], read[1], read[2]
 		if chromosome == genome_chromosome:
 			if genome_start < start < genome_end or genome_start < end < genome_end:
-				# Keep track of plotted reads
-				new_read = [read[0],read[1],read[2],read[3],read[4], False]
-				plottedReads.append(new_read)
-		
-	# Sort plotted reads based on start position
-	sortedPlottedReads = sorted(plottedReads, key=itemgetter(2))
-
-	# Make y position go up after every iteration
-	for y_pos in range(1, len(sortedPlottedReads), 1):
-		lastPlottedEnd = genome_start
-		for read in sortedPlottedReads:
-			chromosome, start, end, blockstarts, blockwidths, plotted = read[0], read[1], read[2], read[3], read[4], read[5]
-			if plotted is False:
-				if start > lastPlottedEnd:
-					rect = mplpatches.Rectangle((start, y_pos+width), 
-												end-start, 
-												line_thin, 
-												facecolor=color, 
-												edgecolor=color,
-												linewidth=0)
-					panel.add_patch(rect)
-					# color by exons: helpful if decide a different color
-					for index in np.arange(0, len(blockstarts), 1):
-						blockstart = blockstarts[index]
-						blockwidth = blockwidths[index]
-						rect = mplpatches.Rectangle((blockstart, y_pos),
-						 							blockwidth,
-						 							line_thick, 
-													facecolor=color, 
-													edgecolor=color, 
-													linewidth=0)
-						panel.add_patch(rect)
-					read[5] = True
-					lastPlottedEnd = end
-
-	return y_pos
-
-# Define figure dimentions
-figureHeight = 5
-figureWidth = 10
-plt.figure(figsize = (figureWidth, figureHeight))
-
-# Set panels: left,bottom, width,height
-panel1 = panel_params(0 ,0.65, figureWidth, figureHeight)
-panel2 = panel_params(0, 0.35, figureWidth, figureHeight)
-panel3 = panel_params(0, 0.05, figureWidth, figureHeight)
-
-# Define genomic region of interest
-#genomicCoord = ['chr1', 155184054, 155194688] # MUC1
-#genomicCoord = ['chr3', 89229057, 8923338] # MUC1 mouse
-#genomicCoord = ['chr12', 25205246, 25250929] # KRAS
-genomicCoord = ['chr7', 45232945, 45240000]
-
-# Plot transcripts in panel 1
-transcriptList = readGtf(genomeFile)
-panel1_thin = 0.1
-panel1_thick = 0.24
-panel1_width = 0.19
-panel1_color="#2166AC"
-bottom = plotTranscripts(panel1, transcriptList, genomicCoord, panel1_thin, panel1_thick, panel1_width, panel1_color)
-panel1.set_xlim(genomicCoord[1], genomicCoord[2])
-panel1.set_ylim(0.24, 10.05)
-
-# Plot reads for panel 3
-readList2 = readData(readsFile1)
-panel3_thin = 0.1
-panel3_thick = 0.5
-panel3_width = 0.2
-panel3_color="#228B3B" # "#40AD5A"
-bottom2 = plotReads(panel3, readList2, genomicCoord, panel3_thin, panel3_thick, panel3_width, panel3_color)
-panel3.set_xlim(genomicCoord[1], genomicCoord[2])
-panel3.set_ylim(0, 436)
-
-# Plot reads for panel 2
-readList1 = readData(readsFile2)
-panel2_thin = 0.08
-panel2_thick = 0.5
-panel2_width = 0.21
-panel2_color="#D6604D"
-bottom1 = plotReads(panel2, readList1, genomicCoord, panel2_thin, panel2_thick, panel2_width, panel2_color)
-panel2.set_xlim(genomicCoord[1], genomicCoord[2])
-panel2.set_ylim(0.2, 69.5)
-
-# Save figure
-plt.savefig(outFile, dpi=1200)
+				plottedReads.append(read)
+	starts = np.array([read[1] for read in plottedReads], dtype=int)
+	ends = np.array([read[2] for read in plottedReads], dtype=int)
+
+	return plottedReads, packRows(starts, ends)
+
+# Plot reads on the rows given by stackReads
+def plotReads(panel, plottedReads, rows, line_thin, line_thick, width, color):
+	if not plottedReads:
+		return 0
+
+	starts = np.array([read[1] for read in plottedReads])
+	ends = np.array([read[2] for read in plottedReads])
+	addRectangles(panel, starts, rows+width, ends-starts, line_thin, color)
+
+	# Aligned blocks of every read in one collection
+	blockRows = np.repeat(rows, [len(read[3]) for read in plottedReads])
+	blockstarts = np.concatenate([read[3] for read in plottedReads])
+	blockwidths = np.concatenate([read[4] for read in plottedReads])
+	addRectangles(panel, blockstarts, blockRows, blockwidths, line_thick, color)
+
+	return rows.max()
+
+# Sorted block starts and ends of the reads with their prefix sums. The covered
+# length left of x is sum(clip(x - blockstart, 0, blockwidth)), which these give
+# for any set of positions, so one coverage track serves every bin size
+def buildCoverage(readList):
+    if not readList:
+        blockstarts = blockends = np.zeros(0)
+    else:
+        blockstarts = np.sort(np.concatenate([read[3] for read in readList])).astype(float)
+        blockends = np.sort(np.concatenate([read[3]+read[4] for read in readList])).astype(float)
+    startSums = np.concatenate([[0], np.cumsum(blockstarts)])
+    endSums = np.concatenate([[0], np.cumsum(blockends)])
+
+    return blockstarts, blockends, startSums, endSums
+
+# Mean read depth between consecutive bin edges
+def binCoverage(coverage, edges):
+    blockstarts, blockends, startSums, endSums = coverage
+    startCount = np.searchsorted(blockstarts, edges)
+    endCount = np.searchsorted(blockends, edges)
+    coveredLength = (startCount*edges - startSums[startCount]) - (endCount*edges - endSums[endCount])
+
+    return np.diff(coveredLength) / np.diff(edges)
+
+# Plot read depth as a histogram instead of individual reads
+def plotCoverage(panel, edges, depth, color, depthMax=None):
+    addRectangles(panel, edges[:-1], 0, np.diff(edges), depth, color)
+    if depthMax is None:
+        depthMax = depth.max(initial=0)
+    panel.set_ylim(0, max(depthMax, 1)*1.05)
+
+    return depthMax
+
+# Plot one read panel: individual reads, or depth when given one or when the
+# reads do not fit: above -t reads, or by default more rows than ylim shows
+def plotReadPanel(panel, readIndex, genomicCoord, line_thin, line_thick, width, color, ylim, depth=None):
+    if depth is None:
+        readList = queryIndex(readIndex, genomicCoord[0], genomicCoord[1], genomicCoord[2])
+        if coverageThreshold is None:
+            plottedReads, rows = stackReads(readList, genomicCoord)
+            tooDeep = rows.max(initial=0) + line_thick > ylim[1]
+        else:
+            tooDeep = len(readList) > coverageThreshold
+            if not tooDeep:
+                plottedReads, rows = stackReads(readList, genomicCoord)
+        if tooDeep:
+            edges = np.linspace(genomicCoord[1], genomicCoord[2], 2001)
+            depth = (edges, binCoverage(buildCoverage(readList), edges), None)
+    if depth is None:
+        plotReads(panel, plottedReads, rows, line_thin, line_thick, width, color)
+        panel.set_ylim(ylim)
+    else:
+        plotCoverage(panel, depth[0], depth[1], color, depth[2])
+    panel.set_xlim(genomicCoord[1], genomicCoord[2])
+
+# Draw transcripts and both read panels on the current figure
+def drawLocus(genomicCoord, depth1=None, depth2=None):
+
+    # Set panels: left,bottom, width,height (relative to the 10x5 inch layout)
+    panel1 = panel_params(0 ,0.65, 10, 5)
+    panel2 = panel_params(0, 0.35, 10, 5)
+    panel3 = panel_params(0, 0.05, 10, 5)
+
+    # Plot transcripts in panel 1
+    panel1_thin = 0.1
+    panel1_thick = 0.24
+    panel1_width = 0.19
+    panel1_color="#2166AC"
+    plotTranscripts(panel1, annotation, genomicCoord, panel1_thin, panel1_thick, panel1_width, panel1_color)
+    panel1.set_xlim(genomicCoord[1], genomicCoord[2])
+    panel1.set_ylim(0.24, 10.05)
+
+    # Plot reads for panel 3
+    panel3_thin = 0.1
+    panel3_thick = 0.5
+    panel3_width = 0.2
+    panel3_color="#228B3B" # "#40AD5A"
+    plotReadPanel(panel3, readIndex1, genomicCoord, panel3_thin, panel3_thick, panel3_width, panel3_color, (0, 436), depth1)
+
+    # Plot reads for panel 2
+    panel2_thin = 0.08
+    panel2_thick = 0.5
+    panel2_width = 0.21
+    panel2_color="#D6604D"
+    plotReadPanel(panel2, readIndex2, genomicCoord, panel2_thin, panel2_thick, panel2_width, panel2_color, (0.2, 69.5), depth2)
+
+# Render one region to outFile from the parsed annotation and indexed reads
+def renderLocus(genomicCoord, outFile):
+
+    # Define figure dimentions
+    figureHeight = 5
+    figureWidth = 10
+    figure = plt.figure(figsize = (figureWidth, figureHeight))
+    drawLocus(genomicCoord)
+
+    # Save figure
+    plt.savefig(outFile, dpi=1200)
+    plt.close(figure)
+
+    return outFile
+
+# Render one map tile; coarse tiles get precomputed depth instead of reads
+def renderTile(genomicCoord, outFile, depth1=None, depth2=None):
+    figure = plt.figure(figsize = (tileWidthPx/tileDpi, tileHeightPx/tileDpi))
+    drawLocus(genomicCoord, depth1, depth2)
+    os.makedirs(os.path.dirname(outFile), exist_ok=True)
+    plt.savefig(outFile, dpi=tileDpi)
+    plt.close(figure)
+
+    return outFile
+
+# Lay out tiles for every zoom level (zoom 0 is the widest tile), skipping empty
+# windows. Depth for coarse zooms is binned once per chromosome from an
+# aggregated coverage track and sliced per tile, so all tiles of a zoom level
+# share one depth scale. Writes tileDir/manifest.json and returns the render jobs
+def planTiles(tileDir, tileWidths, regions):
+    tileWidths = sorted(tileWidths, reverse=True)
+    manifest = {'tileWidthPx': tileWidthPx, 'tileHeightPx': tileHeightPx, 'tileBins': tileBins,
+                'zooms': [{'zoom': zoom, 'width': width, 'track': 'reads' if zoom == len(tileWidths)-1 else 'coverage'}
+                          for zoom, width in enumerate(tileWidths)],
+                'tiles': []}
+    jobs = []
+
+    chromNames = set(readIndex1) | set(readIndex2) | set(str(chromosome) for chromosome in annotation['chromNames'])
+    for chromosome in sorted(chromNames):
+        extents = [index[chromosome][1][-1] for index in (readIndex1, readIndex2) if chromosome in index]
+        chromIds = np.flatnonzero(annotation['chromNames'] == chromosome)
+        if len(chromIds) > 0:
+            extents.append(annotation['ends'][annotation['chromIds'] == chromIds[0]].max())
+        extent = int(max(extents))
+        coverage1 = buildCoverage(readIndex1[chromosome][3] if chromosome in readIndex1 else [])
+        coverage2 = buildCoverage(readIndex2[chromosome][3] if chromosome in readIndex2 else [])
+
+        for zoom, width in enumerate(tileWidths):
+            columns = range(-(-extent // width))
+            if regions is not None:
+                columns = [column for column in columns
+                           if any(region[0] == chromosome and region[1] < (column+1)*width and region[2] > column*width
+                                  for region in regions)]
+            if zoom < len(tileWidths)-1:
+                columnCount = max(columns, default=-1) + 1
+                edges = np.linspace(0, columnCount*width, columnCount*tileBins+1)
+                depth1, depth2 = binCoverage(coverage1, edges), binCoverage(coverage2, edges)
+                depthMax1, depthMax2 = depth1.max(initial=0), depth2.max(initial=0)
+
+            for column in columns:
+                genomicCoord = [chromosome, int(column*width), int((column+1)*width)]
+                if not (queryIndex(readIndex1, *genomicCoord) or queryIndex(readIndex2, *genomicCoord)
+                        or queryAnnotation(annotation, *genomicCoord)):
+                    continue
+                tileFile = os.path.join(str(zoom), chromosome, '%d.png' % column)
+                manifest['tiles'].append({'zoom': zoom, 'chromosome': chromosome, 'start': genomicCoord[1],
+                                          'end': genomicCoord[2], 'file': tileFile})
+                if zoom < len(tileWidths)-1:
+                    tileEdges = edges[column*tileBins:(column+1)*tileBins+1]
+                    binSlice = slice(column*tileBins, (column+1)*tileBins)
+                    jobs.append((genomicCoord, os.path.join(tileDir, tileFile),
+                                 (tileEdges, depth1[binSlice], depthMax1), (tileEdges, depth2[binSlice], depthMax2)))
+                else:
+                    jobs.append((genomicCoord, os.path.join(tileDir, tileFile)))
+
+    os.makedirs(tileDir, exist_ok=True)
+    with open(os.path.join(tileDir, 'manifest.json'), 'w') as manifestFile:
+        json.dump(manifest, manifestFile, indent=1)
+
+    return jobs
+
+# Widen regions to every tile window touching them at any zoom, so tiles are
+# drawn from all reads in their window rather than only those in the regions
+def tileWindows(regions, tileWidths):
+    return [[region[0], min(region[1]//width*width for width in tileWidths),
+             max(-(-region[2]//width)*width for width in tileWidths)] for region in regions]
+
+# Define genomic regions of interest: BED regions, or a single region
+if regionsFile:
+    regions = readRegions(regionsFile)
+else:
+    #genomicCoord = ['chr1', 155184054, 155194688] # MUC1
+    #genomicCoord = ['chr3', 89229057, 8923338] # MUC1 mouse
+    #genomicCoord = ['chr12', 25205246, 25250929] # KRAS
+    genomicCoord = ['chr7', 45232945, 45240000]
+    regions = [genomicCoord]
+
+# Tiles cover the BED regions if given, otherwise every chromosome end to end
+if tileDir and not regionsFile:
+    regions = None
+readWindows = regions
+if tileDir and regions is not None:
+    readWindows = tileWindows(regions, tileWidths)
+
+# Seek straight to the regions in indexed copies of the reads
+if args.index_reads:
+    readsFile1 = indexReads(readsFile1)
+    readsFile2 = indexReads(readsFile2)
+
+# Parse annotation and reads once for all regions
+annotation = loadGtf(genomeFile, cacheDir)
+readIndex1 = buildIndex(readData(readsFile1, readWindows))
+readIndex2 = buildIndex(readData(readsFile2, readWindows))
+
+# Tiles, one output file per BED region, or a single figure
+if tileDir:
+    jobs = planTiles(tileDir, tileWidths, regions)
+    render = renderTile
+elif regionsFile:
+    os.makedirs(outFile, exist_ok=True)
+    jobs = [(region[:3], os.path.join(outFile, region[3]+'.png')) for region in regions]
+    render = renderLocus
+else:
+    jobs = [(genomicCoord, outFile)]
+    render = renderLocus
+
+# Forked workers share the parsed arrays above instead of re-reading them
+if len(jobs) > 1 and processes > 1 and 'fork' in multiprocessing.get_all_start_methods():
+    with multiprocessing.get_context('fork').Pool(min(processes, len(jobs))) as pool:
+        pool.starmap(render, jobs, chunksize=1)
+else:
+    for job in jobs:
+        render(*job)
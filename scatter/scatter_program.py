@@ -8,7 +8,14 @@
 #   Program takes an input text file in which the first column are genes, second
 #   column are the replicate 1 counts, and third column, replicate 2 counts.
 #   The program was written to be run in the command line, but could be slightly 
-#   modify to be run in Jupyter notebook. 
+#   modify to be run in Jupyter notebook. With -r, the scatter panels are drawn
+#   as a density image rasterized at the output resolution, which takes about
+#   the same time for any number of genes.
+#   -i also takes a quoted glob. Several matching tables are binned by a pool
+#   of -p forked workers, each sending back only its count grids, and drawn as
+#   one merged density figure; -m adds a figure of per-file small multiples.
+#   The input may also be gzip (.gz) or zip compressed; it is read by
+#   count_loader.py, which must sit next to this program.
 #
 #   Program execution:
 #   python3 /Users/carlosarevalo/Desktop/scatter_program.py \
@@ -16,42 +23,91 @@
 #       -o /Users/carlosarevalo/Downloads/scatter_test.png \
 #       -s /Users/carlosarevalo/Downloads/stylesheet.mplstyle 
 #
+#   python3 /Users/carlosarevalo/Desktop/scatter_program.py \
+#       -i "/Users/carlosarevalo/Downloads/counts/*.txt.gz" \
+#       -o /Users/carlosarevalo/Downloads/scatter_merged.png \
+#       -m /Users/carlosarevalo/Downloads/scatter_samples.png \
+#       -s /Users/carlosarevalo/Downloads/stylesheet.mplstyle 
+#
 ################################################################################
 
 # Use args to input data
 import matplotlib.pyplot as plt 
 import matplotlib.patches as mplpatches
 import numpy as np 
+import multiprocessing
 import argparse
+import glob
+import os
+from count_loader import load_counts, CountHistogram
 
 # Make instances of an argument parser and define arguments
 parser = argparse.ArgumentParser()
-parser.add_argument("-i", "--input_file")
-parser.add_argument("-o", "--output_file")
+parser.add_argument("-i", "--input_file",
+                    help="count table, or a quoted glob of tables to merge")
+parser.add_argument("-o", "--output_file", default="scatter_test.png")
 parser.add_argument("-s", "--style_sheet") 
+parser.add_argument("-r", "--rasterize", action="store_true",
+                    help="draw scatter panels as one density image instead of one marker per gene")
+parser.add_argument("-m", "--small_multiples",
+                    help="also save one small density panel per input file to this figure")
+parser.add_argument("-p", "--processes", type=int, default=os.cpu_count() or 1,
+                    help="worker processes used to bin several input files")
 
 # Read input file and style sheet
 args = parser.parse_args()
 style_sheet = args.style_sheet
 plt.style.use(args.style_sheet)
 inFile = args.input_file
+outFile = args.output_file
+rasterize = args.rasterize
+multiplesFile = args.small_multiples
+processes = args.processes
+dpi = 600
+multiplesDpi = 150
+inFiles = sorted(glob.glob(inFile)) or [inFile]
+# Points are only loaded for a single file; merged inputs are drawn from bins
+if len(inFiles) > 1 or multiplesFile:
+    rasterize = True
 # inFile=open("/Users/carlosarevalo/Downloads/test_input_data_1.txt", "r")
 
-# Make lists of input values:
-x_values = []
-y_values = []
+# Shade a pixel count grid, (width_px, height_px) as binned by CountHistogram.
+# Each point covers a marker-sized disc of pixels, and a pixel with n covering
+# points gets the shade of n overlapping markers of the given alpha:
+# 1 - (1 - alpha)**n
+def density_image(counts, marker_px, alpha):
+    counts = counts.T
+    height_px, width_px = counts.shape
+
+    # Spread counts over the marker footprint, one shifted grid per disc offset
+    radius = marker_px/2
+    reach = int(np.ceil(radius))
+    padded = np.pad(counts, reach)
+    covered = np.zeros(counts.shape, dtype=np.int64)
+    for dy in range(-reach, reach + 1):
+        for dx in range(-reach, reach + 1):
+            if dx*dx + dy*dy <= radius*radius:
+                covered += padded[reach + dy:reach + dy + height_px, reach + dx:reach + dx + width_px]
+
+    shade = (1 - alpha)**covered
+    return np.repeat(shade[:, :, np.newaxis], 3, axis=2)
 
-# Read input data
-with open(inFile, "r") as inFile:
-    for line in inFile.readlines():
-        splitline = line.strip().split("\t")
-        name = splitline[0]
-        x_values.append(int(splitline[1]))
-        y_values.append(int(splitline[2]))
-    pass
+# Sum factor x factor blocks of a count grid, for drawing it at a lower dpi
+def shrink_grid(counts, factor):
+    xBins, yBins = counts.shape[0]//factor, counts.shape[1]//factor
+    return counts[:xBins*factor, :yBins*factor].reshape(xBins, factor, yBins, factor).sum(axis=(1, 3))
+
+# Bin one count table with the density figure's bins. Run in the worker
+# processes, which send back only the histogram
+def bin_file(inFile):
+    histogram = CountHistogram(np.arange(0, 15, 0.5), (0, 15, 0, 15), (width_px, height_px))
+    return histogram.add_file(inFile)
+
+# Draw a density image filling the panel's data limits
+def plot_density(panel, image, xlim, ylim):
+    panel.imshow(image, origin = "lower", extent = [xlim[0], xlim[1], ylim[0], ylim[1]],
+                 interpolation = "nearest", aspect = "auto")
 
-x_vals = np.log2([x + 1 for x in np.array(x_values)])
-y_vals = np.log2([y + 1 for y in np.array(y_values)])
 
 # Define figure dimensions:
 figureHeight = 2
@@ -111,24 +167,54 @@ y_panel2.tick_params(bottom=True, labelbottom=True,
                     right=False, labelright=False,
                     top=False, labeltop=False)
 
+# Bin marginals (0.5 wide) from 0 to 15. The density image is binned from the
+# same pass at the panel's pixel size, streaming the table block by block so
+# only the bins are kept in memory; without -r every point is loaded
+if rasterize:
+    width_px = int(round(panelWidth*figureWidth*dpi))
+    height_px = int(round(panelHeight*figureHeight*dpi))
+    marker_px = max(1, int(round(1.5/72*dpi)))
+    histogram = CountHistogram(np.arange(0, 15, 0.5), (0, 15, 0, 15), (width_px, height_px))
+    thumbnails = []
+    pool = None
+    fileHistograms = map(bin_file, inFiles)
+    if len(inFiles) > 1 and processes > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        pool = multiprocessing.get_context('fork').Pool(min(processes, len(inFiles)))
+        fileHistograms = pool.imap(bin_file, inFiles)
+    for fileHistogram in fileHistograms:
+        histogram.merge(fileHistogram)
+        if multiplesFile:
+            thumbnails.append(shrink_grid(fileHistogram.grid, dpi//multiplesDpi))
+    if pool is not None:
+        pool.close()
+        pool.join()
+else:
+    x_vals, y_vals = load_counts(inFiles[0])
+    histogram = CountHistogram(np.arange(0, 15, 0.5))
+    histogram.add(x_vals, y_vals)
+
 # Panel 1 scatter plot:
-panel1.plot(x_vals,y_vals,
-    marker = 'o',
-    markerfacecolor = (0, 0, 0),
-    markeredgecolor = (0, 0, 0),
-    markersize = 1.5,
-    markeredgewidth = 0,
-    linewidth = 0,
-    alpha = 0.1)
+if rasterize:
+    density = density_image(histogram.grid, marker_px, 0.1)
+    plot_density(panel1, density, (0, 15), (0, 15))
+else:
+    panel1.plot(x_vals,y_vals,
+        marker = 'o',
+        markerfacecolor = (0, 0, 0),
+        markeredgecolor = (0, 0, 0),
+        markersize = 1.5,
+        markeredgewidth = 0,
+        linewidth = 0,
+        alpha = 0.1)
 # panel1.text(0,0,'r='+str(round(stats.spearmanr(xList,yList)[0],2)))
 # print(round(stats.spearmanr(xList,yList)[0],2))
-panel1.set_xlim(0, max(x_vals))
-panel1.set_ylim(0, max(y_vals))
+panel1.set_xlim(0, histogram.xMax)
+panel1.set_ylim(0, histogram.yMax)
 
 
 # Add histograms to panel group 1:
-x_hist_vals, x_hist_bins = np.histogram(x_vals, np.arange(0, 15, 0.5))
-y_hist_vals, y_hist_bins = np.histogram(y_vals, np.arange(0, 15, 0.5))
+x_hist_vals = histogram.xHist
+y_hist_vals = histogram.yHist
 
 # Plot histograms to Panel 1
 for i in np.arange(0, len(x_hist_vals), 1):
@@ -171,16 +257,19 @@ y_panel1.set_yticks(np.arange(0, 16, 5))
 #                                        linewidth = 1)
 #        panel2.add_patch(rectangle)
 
-panel2.plot(x_vals, y_vals,
-    marker = 'o',
-    markerfacecolor = (0, 0, 0),
-    markeredgecolor = (0, 0, 0),
-    markersize = 1.5,
-    markeredgewidth = 0,
-    linewidth = 0,
-    alpha = 0.1)    
-panel2.set_xlim(0, max(x_vals))
-panel2.set_ylim(0, max(y_vals))
+if rasterize:
+    plot_density(panel2, density, (0, 15), (0, 15))
+else:
+    panel2.plot(x_vals, y_vals,
+        marker = 'o',
+        markerfacecolor = (0, 0, 0),
+        markeredgecolor = (0, 0, 0),
+        markersize = 1.5,
+        markeredgewidth = 0,
+        linewidth = 0,
+        alpha = 0.1)    
+panel2.set_xlim(0, histogram.xMax)
+panel2.set_ylim(0, histogram.yMax)
 
 # Plot histograms to Panel 2
 for i in np.arange(0, len(x_hist_vals), 1):
@@ -213,4 +302,29 @@ y_panel2.set_xlim(20, 0)
 panel2.set_xticks(np.arange(0, 16, 5))
 
 # Save figure
-plt.savefig('scatter_test.png', dpi=600)
+plt.savefig(outFile, dpi=dpi)
+
+# Small multiples: one 1 x 1 inch density panel per input file, in rows
+if multiplesFile:
+    columns = int(np.ceil(np.sqrt(len(inFiles))))
+    rows = int(np.ceil(len(inFiles)/columns))
+    cellWidth = 1.4
+    cellHeight = 1.5
+    multiplesWidth = columns*cellWidth
+    multiplesHeight = rows*cellHeight
+    plt.figure(figsize = (multiplesWidth, multiplesHeight))
+    small_marker_px = max(1, int(round(1.5/72*multiplesDpi)))
+    for index in range(len(inFiles)):
+        row, column = divmod(index, columns)
+        small_panel = plt.axes([(column*cellWidth + 0.3)/multiplesWidth,
+                                ((rows - row - 1)*cellHeight + 0.25)/multiplesHeight,
+                                1/multiplesWidth, 1/multiplesHeight])
+        density = density_image(thumbnails[index], small_marker_px, 0.1)
+        plot_density(small_panel, density, (0, 15), (0, 15))
+        small_panel.set_xlim(0, 15)
+        small_panel.set_ylim(0, 15)
+        small_panel.set_xticks(np.arange(0, 16, 5))
+        small_panel.set_yticks(np.arange(0, 16, 5))
+        small_panel.tick_params(labelsize = 5)
+        small_panel.set_title(os.path.basename(inFiles[index]), fontsize = 5)
+    plt.savefig(multiplesFile, dpi=multiplesDpi)
@@ -0,0 +1,140 @@
+
+################################################################################
+#
+#   Author: Carlos Arevalo
+#   Email: carevalo0170@gmail.com
+#
+#   Program description:
+#   Count table loader shared by scatter_program.py and
+#   scatter_heatmap_program.py. Input is a tab-delimited file in which the first
+#   column are genes, second column are the replicate 1 counts, and third
+#   column, replicate 2 counts. Plain text, gzip (.gz) and zip archives are read
+#   directly; the table is parsed blockSize lines at a time straight into NumPy
+#   arrays and log2(count + 1) transformed in place. CountHistogram bins the
+#   blocks as they are read, so marginal and 2D counts of tables larger than
+#   memory can be plotted without keeping the values.
+#
+#   Usage:
+#   from count_loader import load_counts, CountHistogram
+#   x_vals, y_vals = load_counts("test_input_data_1.txt.zip")
+#   histogram = CountHistogram().add_file("test_input_data_1.txt.zip")
+#
+################################################################################
+
+import numpy as np
+import itertools
+import zipfile
+import gzip
+import io
+import os
+
+# Open a plain, gzip or zip count table as text; zip archives use their first
+# data member, skipping folders and macOS "__MACOSX/" / "._" resource forks
+def open_counts(inFile):
+    if inFile.endswith(".gz"):
+        return gzip.open(inFile, "rt")
+    if zipfile.is_zipfile(inFile):
+        with zipfile.ZipFile(inFile) as archive:
+            members = [name for name in archive.namelist()
+                       if not name.endswith("/")
+                       and not name.startswith("__MACOSX/")
+                       and not os.path.basename(name).startswith(".")]
+            if not members:
+                raise ValueError("%s: no data file in zip archive" % inFile)
+            # the member stays readable after the archive handle is closed
+            member = archive.open(members[0])
+        return io.TextIOWrapper(member)
+    return open(inFile, "r")
+
+# Yield (genes, rep1, rep2) arrays for each block of blockSize lines; counts are
+# log2(count + 1) float64, genes is None unless names=True
+def iter_counts(inFile, blockSize=1000000, names=False):
+    with open_counts(inFile) as lines:
+        while True:
+            block = list(itertools.islice(lines, blockSize))
+            if not block:
+                break
+            values = np.loadtxt(block, delimiter="\t", usecols=(1, 2),
+                                dtype=np.float64, ndmin=2)
+            np.add(values, 1, out=values)
+            np.log2(values, out=values)
+            genes = None
+            if names:
+                genes = np.loadtxt(block, delimiter="\t", usecols=0,
+                                   dtype=str, ndmin=1)
+            yield genes, values[:, 0], values[:, 1]
+
+# Load a whole count table as log2(count + 1) replicate arrays; with names=True
+# the gene column is returned first
+def load_counts(inFile, blockSize=1000000, names=False):
+    genes, x_vals, y_vals = [], [], []
+    for geneBlock, xBlock, yBlock in iter_counts(inFile, blockSize, names):
+        genes.append(geneBlock)
+        x_vals.append(xBlock)
+        y_vals.append(yBlock)
+    x_vals = np.concatenate(x_vals) if x_vals else np.empty(0)
+    y_vals = np.concatenate(y_vals) if y_vals else np.empty(0)
+    if names:
+        genes = np.concatenate(genes) if genes else np.empty(0, dtype=str)
+        return genes, x_vals, y_vals
+    return x_vals, y_vals
+
+# Fixed-bin counts of log2 replicate values, filled one block at a time. Holds
+# the rep1 (x) and rep2 (y) marginals over histEdges, binned like np.histogram,
+# and, when gridShape is given, a (xBins, yBins) grid over gridRange =
+# (xmin, xmax, ymin, ymax) whose bins are half-open and drop points outside.
+# Histograms filled from separate blocks, files or worker processes with the
+# same bins are combined with merge()
+class CountHistogram:
+    def __init__(self, histEdges=np.arange(0, 15, 0.5), gridRange=None, gridShape=None):
+        self.histEdges = np.asarray(histEdges, dtype=np.float64)
+        self.xHist = np.zeros(len(self.histEdges) - 1, dtype=np.int64)
+        self.yHist = np.zeros(len(self.histEdges) - 1, dtype=np.int64)
+        self.gridRange = None if gridShape is None else tuple(gridRange)
+        self.grid = None if gridShape is None else np.zeros(gridShape, dtype=np.int64)
+        self.count = 0
+        self.xMax = -np.inf
+        self.yMax = -np.inf
+
+    # Bin one block of values
+    def add(self, x_vals, y_vals):
+        x_vals = np.asarray(x_vals, dtype=np.float64)
+        y_vals = np.asarray(y_vals, dtype=np.float64)
+        if len(x_vals) == 0:
+            return self
+        self.count += len(x_vals)
+        self.xMax = max(self.xMax, x_vals.max())
+        self.yMax = max(self.yMax, y_vals.max())
+        self.xHist += np.histogram(x_vals, self.histEdges)[0]
+        self.yHist += np.histogram(y_vals, self.histEdges)[0]
+        if self.grid is not None:
+            xmin, xmax, ymin, ymax = self.gridRange
+            xBins, yBins = self.grid.shape
+            xIndex = np.floor((x_vals - xmin)/(xmax - xmin)*xBins).astype(np.int64)
+            yIndex = np.floor((y_vals - ymin)/(ymax - ymin)*yBins).astype(np.int64)
+            inside = (xIndex >= 0) & (xIndex < xBins) & (yIndex >= 0) & (yIndex < yBins)
+            self.grid += np.bincount(xIndex[inside]*yBins + yIndex[inside],
+                                     minlength=xBins*yBins).reshape(xBins, yBins)
+        return self
+
+    # Stream a count table through add() blockSize lines at a time
+    def add_file(self, inFile, blockSize=1000000):
+        for genes, x_vals, y_vals in iter_counts(inFile, blockSize):
+            self.add(x_vals, y_vals)
+        return self
+
+    # Add the counts of another histogram with the same bins
+    def merge(self, other):
+        if not np.array_equal(self.histEdges, other.histEdges) \
+                or self.gridRange != other.gridRange \
+                or (self.grid is None) != (other.grid is None) \
+                or (self.grid is not None and self.grid.shape != other.grid.shape):
+            raise ValueError("cannot merge histograms with different bins")
+        self.xHist += other.xHist
+        self.yHist += other.yHist
+        if self.grid is not None:
+            self.grid += other.grid
+        self.count += other.count
+        self.xMax = max(self.xMax, other.xMax)
+        self.yMax = max(self.yMax, other.yMax)
+        return self
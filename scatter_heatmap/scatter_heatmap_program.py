@@ -9,6 +9,8 @@
 #   column are the replicate 1 counts, and third column, replicate 2 counts.
 #   The program was written to be run in the command line, but could be slightly 
 #   modified to be run in Jupyter notebook. 
+#   The input may also be gzip (.gz) or zip compressed; it is read by
+#   count_loader.py, which must sit next to this program.
 #
 #   Program execution:
 #   python3 /Users/carevalo/Desktop/scatter_heatmap/scatter_heatmap_program.py \
@@ -23,51 +25,29 @@ import matplotlib.patches as mplpatches
 import numpy as np 
 import warnings
 import argparse
+from count_loader import load_counts, CountHistogram
 
-def general_flooring(number, floor):
-  return int(number/floor)*floor
-
-# heatmap function
-def heatmap(xList, yList, panel2, xmin, xmax, ymin, ymax, binsize):
+# heatmap function: counts is an (xBins, yBins) grid drawn over
+# extent = [xmin, xmax, ymin, ymax]
+def heatmap(counts, panel2, extent):
   white = (1, 1, 1)
   black = (0, 0, 0)
   R = np.linspace(white[0], black[0], 21)
   B = np.linspace(white[1], black[1], 21)
   G = np.linspace(white[2], black[2], 21)
-  dataDict = {}
-  for xBin in np.arange(xmin, xmax, binsize):
-    dataDict[xBin] = {}
-    for yBin in np.arange(ymin, ymax, binsize):
-      dataDict[xBin][yBin] = 0
-
-  for i in np.arange(0, len(xList), 1):
-    x = xList[i]
-    y = yList[i]
-    xFloored = general_flooring(x, binsize) # 7.9 becomes to 7
-    yFloored = general_flooring(y, binsize)
-    if xFloored in dataDict:
-      if yFloored in dataDict[xFloored]:
-        dataDict[xFloored][yFloored] += 1 # iterates up by 1
 
-  for xBin in np.arange(xmin, xmax, binsize):
-    for yBin in np.arange(ymin, ymax, binsize):
-      value = min(dataDict[xBin][yBin], 20)
-      color = (R[value], G[value], B[value])
-      rect = mplpatches.Rectangle((xBin, yBin), binsize, binsize,
-                                  facecolor = color, 
-                                  edgecolor = (0, 0, 0),
-                                  linewidth = 0)
-      panel2.add_patch(rect)
+  # Look up every cell's color at once and draw the grid as a single image
+  lut = np.stack([R, G, B], axis=1)
+  image = lut[np.minimum(counts, 20)].transpose(1, 0, 2)
+  panel2.imshow(image, origin = "lower",
+                extent = extent,
+                interpolation = "nearest", aspect = "auto")
 
-  # Add heatmap scale
+  # Add heatmap scale: one band per unit from 0 to 20
   color_range = np.linspace(0, 1, 20)
-  print(color_range)
-  colors = [(1-i, 1-i, 1-i) for i in color_range]
-  for color in colors:
-    patch = mplpatches.Rectangle((0, colors.index(color) + 0), 1, 21, 
-                                linewidth = 0, 
-                                facecolor = color)
-    panel.add_patch(patch)
+  colors = np.array([(1-i, 1-i, 1-i) for i in color_range])
+  panel.imshow(colors[:, np.newaxis, :], origin = "lower", extent = [0, 1, 0, 20],
+               interpolation = "nearest", aspect = "auto")
                               
 # Make instances of an argument parser and define arguments
 parser = argparse.ArgumentParser()
@@ -82,20 +62,15 @@ plt.style.use(args.style_sheet)
 inFile = args.input_file
 outFile = args.output_file
 
-# Make lists of input values:
-x_values=[]
-y_values=[]
-
-with open(inFile, "r") as inFile:
-    for line in inFile.readlines():
-        splitline = line.strip().split("\t")
-        name = splitline[0]
-        x_values.append(int(splitline[1]))
-        y_values.append(int(splitline[2]))
-    pass
+# Read replicate counts as log2(count + 1) arrays:
+x_vals, y_vals = load_counts(inFile)
 
-x_vals=np.log2([x+1 for x in np.array(x_values)])
-y_vals=np.log2([y+1 for y in np.array(y_values)])
+# Bin marginals (0.5 wide) and the heatmap grid (0.33 wide) from 0 to 15:
+binsize = 0.33
+gridBins = len(np.arange(0, 15, binsize))
+gridRange = (0, gridBins*binsize, 0, gridBins*binsize)
+histogram = CountHistogram(np.arange(0, 15, 0.5), gridRange, (gridBins, gridBins))
+histogram.add(x_vals, y_vals)
 
 # Define figure dimensions:
 figureHeight=2.5
@@ -168,8 +143,8 @@ panel1.set_xlim(0, max(x_vals))
 panel1.set_ylim(0, max(y_vals))
 
 # Add histograms to panel group 1:
-x_hist_vals, x_hist_bins = np.histogram(x_vals, np.arange(0, 15, 0.5))
-y_hist_vals, y_hist_bins = np.histogram(y_vals, np.arange(0, 15, 0.5))
+x_hist_vals = histogram.xHist
+y_hist_vals = histogram.yHist
 
 # plot histograms
 for i in np.arange(0, len(x_hist_vals), 1):
@@ -212,8 +187,8 @@ for i in np.arange(0, len(x_hist_vals), 1):
     x_panel2.add_patch(rect1)
     y_panel2.add_patch(rect2)
 
-# Plot heatmap: xList, yList, panel, xmin, xmax, ymin, ymax, binsize
-heatmap(x_vals, y_vals, panel2, 0, 15, 0, 15, 0.33)
+# Plot heatmap: counts, panel, extent
+heatmap(histogram.grid, panel2, gridRange)
 panel2.set_xlim(0, max(x_vals))
 panel2.set_ylim(0, max(y_vals))
 
@@ -257,7 +232,8 @@ ticks = [x for x in range(0, 20, 10)]
 ticks.append(">20")
 
 # print(ticks) 
-panel.set_ylim(0, 20.00000001, 10)
+panel.set_ylim(0, 20.00000001)
+panel.set_yticks([0, 10, 20])
 panel.set_yticklabels(ticks) #np.arange(0, 21, 10))
 panel.set_xticks([])
 
@@ -7,6 +7,18 @@
 #   Program description:
 #   Program takes as input fasta file. The program was written to be executed 
 #   in the command line and could be slightly modified to Jupyter Notebook. 
+#   Logos cover -w bases (20 by default) centred on the splice site, which lies
+#   --site bases into each sequence (10 by default); bases missing at either end
+#   of a short sequence are not counted. The FASTA may be gzip compressed
+#   or read from stdin when -i is left out; -m memory-maps uncompressed files.
+#   Uncompressed files are split into -j byte ranges starting on record
+#   boundaries and counted by a pool of forked workers, whose 5' and 3' count
+#   matrices are summed.
+#   Letters are drawn as filled font outlines, one collection per logo, unless
+#   -p gives a directory of base PNGs (A_small.png, ...) to draw instead.
+#   The PNGs are packed into one glyph atlas array, cached in --cache_dir keyed
+#   by their paths, sizes and modification times, so later runs load the .npy
+#   atlas instead of decoding the PNGs; pass --cache_dir "" to disable.
 #
 #   Program execution:
 #   python3 /Users/carlosarevalo/Desktop/seq_logos_program.py \
@@ -18,22 +30,44 @@
 ################################################################################
 
 # Required modules
+import matplotlib
+matplotlib.use("Agg") # the logo is only saved to a file
 import matplotlib.pyplot as plt 
-import matplotlib.patches as mplpatches
 import matplotlib.image as mpimg
-from collections import Counter
+from matplotlib.collections import PathCollection
+from matplotlib.font_manager import FontProperties
+from matplotlib.textpath import TextPath
+from matplotlib.path import Path
 import numpy as np 
+import multiprocessing
 import warnings
 import random
+import tempfile
+import hashlib
+import shutil
+import mmap
+import gzip
+import sys
 import os
 import argparse
 
 # Argument parser and definitions
 parser = argparse.ArgumentParser()
 parser.add_argument("-i", "--input_file")
-parser.add_argument("-p", "--pngs")
+parser.add_argument("-p", "--pngs",
+                    help="directory of base PNGs to draw instead of font outlines")
 parser.add_argument("-s", "--style_sheet") 
 parser.add_argument("-o", "--output_file")
+parser.add_argument("-w", "--window", type=int, default=20,
+                    help="number of bases around the splice site to profile")
+parser.add_argument("--site", type=int, default=10,
+                    help="number of bases before the splice site in each sequence")
+parser.add_argument("-m", "--mmap", action="store_true",
+                    help="memory-map an uncompressed input instead of reading it in blocks")
+parser.add_argument("-c", "--cache_dir", default=os.path.join(os.path.expanduser("~"), ".cache", "seq_logos"),
+                    help="directory for base PNG atlas caches; empty string disables caching")
+parser.add_argument("-j", "--processes", type=int, default=os.cpu_count() or 1,
+                    help="worker processes counting byte ranges of an uncompressed input")
 
 # Read input file and style sheet
 args = parser.parse_args()
@@ -42,6 +76,13 @@ plt.style.use(args.style_sheet)
 inFile = args.input_file
 inLogos = args.pngs
 outFile = args.output_file
+window = args.window
+site = args.site
+# Sequence index of the first logo position; the site sits window//2 positions in
+windowStart = site - window//2
+useMmap = args.mmap
+processes = args.processes
+cacheDir = args.cache_dir
 
 # Define figure dimentions
 figureHeight=3
@@ -60,142 +101,284 @@ panel1 = plt.axes([0.5/6, 0.3, relativePanelWidth, relativePanelHeight])
 panel2 = plt.axes([(2.4+1)/6, 0.3, relativePanelWidth, relativePanelHeight])
 
 # Add mid lines
-panel1.plot([10 for i in range(10)], list(range(0,10)), color="black", linewidth=0.5)
-panel2.plot([10 for i in range(10)], list(range(0,10)), color="black", linewidth=0.5)
+panel1.plot([window//2 for i in range(10)], list(range(0,10)), color="black", linewidth=0.5)
+panel2.plot([window//2 for i in range(10)], list(range(0,10)), color="black", linewidth=0.5)
 
-# Class FastAreader was reused and implemented from a BME160 assignment from UCSC
+# Class FastAreader was reused and implemented from a BME160 assignment from UCSC,
+# reworked to scan large binary blocks instead of concatenating lines
 class FastAreader:
-    def __init__ (self, fname=''):
-        '''contructor: saves attribute fname'''
+    def __init__ (self, fname='', blockSize=1<<24, useMmap=False, start=0, end=None):
+        '''contructor: saves attribute fname, read block size, mmap choice and
+        the byte range start-end to read (end None reads to the end)'''
         self.fname = fname
+        self.blockSize = blockSize
+        self.useMmap = useMmap
+        self.start = start
+        self.end = end
             
     def doOpen (self):
-        ''' Handle file opens, allowing STDIN.'''
+        ''' Handle file opens in binary mode, allowing STDIN, gzip and mmap.'''
         if self.fname == '':
-            return sys.stdin
+            return sys.stdin.buffer
+        elif self.fname.endswith('.gz'):
+            return gzip.open(self.fname, 'rb')
+        elif self.useMmap and os.path.getsize(self.fname) > 0:
+            # the map stays valid after the file itself is closed
+            with open(self.fname, 'rb') as fileH:
+                return mmap.mmap(fileH.fileno(), 0, access=mmap.ACCESS_READ)
         else:
-            return open(self.fname)
+            return open(self.fname, 'rb')
+
+    def splitRecords (self, data):
+        ''' Yield header/sequence bytes for every record in data, which holds
+        whole records; sequences lose whitespace and are uppercased.'''
+        # skip to first fasta header
+        start = data.find(b'>')
+        if start < 0:
+            return
+        for record in data[start+1:].split(b'\n>'):
+            header, newline, sequence = record.partition(b'\n')
+            yield header.rstrip(), sequence.translate(None, b' \t\r\n\v\f').upper()
         
     def readFasta (self):
-        ''' Read an entire FastA record and return the sequence header/sequence'''
-        header, sequence = '',''
+        ''' Read FastA records and yield each header/sequence as bytes. Input
+        is read blockSize bytes at a time, and the blocks seen since the last
+        record start are joined only once the next record start shows up.'''
         with self.doOpen() as fileH:
-            header, sequence = '',''
-            # skip to first fasta header
-            line = fileH.readline()
-            while not line.startswith('>') :
-                line = fileH.readline()
-            header = line[1:].rstrip()
-            for line in fileH:
-                if line.startswith ('>'):
-                    yield header,sequence
-                    header = line[1:].rstrip()
-                    sequence = ''
-                else :
-                    sequence += ''.join(line.rstrip().split()).upper()
-
-        yield header,sequence
-
-# Logos dictionary
-logos_dict = {"A":[], "T":[], "C":[], "G":[]}
-
-# Read logos and append them to dictionary
-for path, dirs, img, in os.walk(inLogos):
-    for logosName in img:
-        logoPath = os.path.join(path, logosName)
-        if logoPath.endswith("A_small.png"):
-            A = mpimg.imread(logoPath)
-            logos_dict["A"].append(A)
-        elif logoPath.endswith("T_small.png"):
-            T = mpimg.imread(logoPath)
-            logos_dict["T"].append(T)
-        elif logoPath.endswith("C_small.png"):
-            C = mpimg.imread(logoPath)
-            logos_dict["C"].append(C)
-        elif logoPath.endswith("G_small.png"):
-            G = mpimg.imread(logoPath)
-            logos_dict["G"].append(G)
-        else:
-            continue
-
-# Read fasta sequences
-read_obj = FastAreader(inFile)
-read_obj.doOpen()
-sequenceDict = {}
-
-spliceSite5 = []
-spliceSite3 = []
-
-# Separate sequences by splice site
-for header, sequence in read_obj.readFasta():
-    headerSplit = header.strip().split('_') 
-    spliceDirection = headerSplit[0]
-    position = int()
-    if spliceDirection == "5'":
-        spliceSite5.append(sequence)
+            if self.start:
+                fileH.seek(self.start)
+            remaining = None if self.end is None else self.end - self.start
+            parts = []
+            previous = b''
+            while True:
+                if remaining is None:
+                    block = fileH.read(self.blockSize)
+                else:
+                    block = fileH.read(min(self.blockSize, remaining))
+                    remaining -= len(block)
+                if not block:
+                    break
+                # last record start in the block; -1 when it is right at its beginning
+                cut = block.rfind(b'\n>')
+                startsRecord = block.startswith(b'>') and previous.endswith(b'\n')
+                previous = block
+                if cut < 0 and not startsRecord:
+                    parts.append(block)
+                    continue
+                parts.append(block[:cut+1])
+                yield from self.splitRecords(b''.join(parts))
+                parts = [block[cut+1:]]
+            yield from self.splitRecords(b''.join(parts))
+
+# Base codes: A, C, G, T are 0-3 and any other byte is 4, which is not counted
+bases = "ACGT"
+baseColors = ["#33BD66", "#38429E", "#FFE066", "#FF004F"]
+baseCodes = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate(bases):
+    baseCodes[ord(base)] = code
+    baseCodes[ord(base.lower())] = code
+
+# Atlas layout version; bump when read_glyph_atlas changes what it stores
+atlasVersion = 1
+
+# Pack the base PNGs of a directory side by side into one RGBA atlas array.
+# glyphs holds each base's (height, offset, width) in atlas pixels, in ACGT
+# order; shorter glyphs leave unused transparent rows below them
+def read_glyph_atlas(logoPaths):
+    images = [mpimg.imread(logoPath) for logoPath in logoPaths]
+    glyphs = np.zeros((len(images), 3), dtype=np.int64)
+    for code, image in enumerate(images):
+        glyphs[code] = image.shape[0], glyphs[:code, 2].sum(), image.shape[1]
+    atlas = np.zeros((glyphs[:, 0].max(), glyphs[:, 2].sum(), 4), dtype=np.float32)
+    for image, (height, offset, width) in zip(images, glyphs):
+        if image.ndim == 2:
+            image = np.stack([image]*3, axis=-1)
+        atlas[:height, offset:offset+width, :image.shape[2]] = image
+        if image.shape[2] == 3:
+            atlas[:height, offset:offset+width, 3] = 1
+    return atlas, glyphs
+
+# Cache directory for the atlas of some PNGs, keyed by atlasVersion and the
+# PNGs' paths, sizes and modification times
+def cache_path(logoPaths, cacheDir):
+    key = "%d\n" % atlasVersion
+    for logoPath in logoPaths:
+        stat = os.stat(logoPath)
+        key += "%s\t%d\t%d\n" % (os.path.abspath(logoPath), stat.st_size, stat.st_mtime_ns)
+    return os.path.join(cacheDir, hashlib.sha1(key.encode()).hexdigest())
+
+# Load the atlas of a PNG directory from the cache, packing and writing the
+# cache on a miss. Returns one image per base, each a view into the atlas
+def load_glyph_atlas(logoDir, cacheDir):
+    logoPaths = [os.path.join(logoDir, base + "_small.png") for base in bases]
+    if not cacheDir:
+        atlas, glyphs = read_glyph_atlas(logoPaths)
     else:
-        spliceSite3.append(sequence) 
-    pass
-
-# Sequence range distionaries
-ss5_Dict = {i:[] for i in range(20)}  
-ss3_Dict = {i:[] for i in range(20)}
-
-# Assign sequence range
-for sequence in spliceSite5:
-    for pos in range(20):
-        ss5_Dict[pos].append(sequence[pos])
-
-for sequence in spliceSite3:
-    for pos in range(20):
-        ss3_Dict[pos].append(sequence[pos])
-
-# Calculate 5' splice site frequency, ratios, and plots SS5
-for base in list(ss5_Dict.keys()):
-    height_ss5 = 0
-    freq = Counter(ss5_Dict[base])
-    for i, t in freq.items():
-        freq[i]=float(t/len(ss5_Dict[base]))
-        height_ss5 += -freq[i]*np.log2(freq[i])
-    ratio5 = 2.0 - height_ss5
-    pass
-
-    height = 0
-    for key, value in sorted(freq.items(), key=lambda item: item[1]):
-        imgArray = np.array(logos_dict[key])
-        imgLogo = np.squeeze(imgArray) # remove extra dimensions
-        panel1.imshow(imgLogo, extent=[base, base+1, height, height+(freq[key]*ratio5)], aspect="auto") 
-        height = height + (freq[key]*ratio5)
-    pass
-
-# Calculate 3' splice site frequency, ratios, and plots SS3
-for base in list(ss3_Dict.keys()):
-    height_ss3 = 0
-    freq = Counter(ss3_Dict[base])
-    for i, t in freq.items():
-        freq[i]=float(t/len(ss3_Dict[base]))
-        height_ss3 += -freq[i]*np.log2(freq[i])
-    ratio3 = 2.0 - height_ss3
-    pass
-
-    height = 0
-    for key, value in sorted(freq.items(), key=lambda item: item[1]):
-        imgArray = np.array(logos_dict[key])
-        imgLogo = np.squeeze(imgArray) # remove extra dimensions
-        panel2.imshow(imgLogo, extent=[base, base+1, height, height+(freq[key]*ratio3)], aspect="auto")
-        height = height + (freq[key]*ratio3)
-    pass
+        cachePath = cache_path(logoPaths, cacheDir)
+        if os.path.isdir(cachePath):
+            atlas = np.load(os.path.join(cachePath, "atlas.npy"))
+            glyphs = np.load(os.path.join(cachePath, "glyphs.npy"))
+        else:
+            atlas, glyphs = read_glyph_atlas(logoPaths)
+            # Save both arrays before the cache directory is renamed into place
+            os.makedirs(cacheDir, exist_ok=True)
+            tmpPath = tempfile.mkdtemp(dir=cacheDir)
+            np.save(os.path.join(tmpPath, "atlas.npy"), atlas)
+            np.save(os.path.join(tmpPath, "glyphs.npy"), glyphs)
+            try:
+                os.rename(tmpPath, cachePath)
+            except OSError:
+                shutil.rmtree(tmpPath)
+    return [atlas[:height, offset:offset+width] for height, offset, width in glyphs]
+
+# Base PNG images, read once per run; only needed to draw PNGs
+glyphImages = load_glyph_atlas(inLogos, cacheDir) if inLogos else None
+
+# Count bases at the window positions from sequence index start on, for all
+# sequences at once: the slices are viewed as one (sequences x window) uint8
+# array, padded with N where a sequence ends early, and one-hot summed into a
+# (window x 4) ACGT count matrix
+def count_positions(sequences, window, start=0):
+    pad = b"N"*max(0, -start)
+    first, last = max(start, 0), max(start + window, 0)
+    block = b"".join((pad + sequence[first:last]).ljust(window, b"N") for sequence in sequences)
+    codes = baseCodes[np.frombuffer(block, dtype=np.uint8)].reshape(-1, window)
+    return np.stack([(codes == code).sum(axis=0) for code in range(4)], axis=1)
+
+# Count 5' and 3' splice site sequences separately, batchSize records at a time
+def count_splice_sites(records, window, start=0, batchSize=1000000):
+    counts5 = np.zeros((window, 4), dtype=np.int64)
+    counts3 = np.zeros((window, 4), dtype=np.int64)
+    spliceSite5 = []
+    spliceSite3 = []
+    for header, sequence in records:
+        headerSplit = header.strip().split(b'_') 
+        spliceDirection = headerSplit[0]
+        if spliceDirection == b"5'":
+            spliceSite5.append(sequence)
+        else:
+            spliceSite3.append(sequence) 
+        if len(spliceSite5) + len(spliceSite3) >= batchSize:
+            counts5 += count_positions(spliceSite5, window, start)
+            counts3 += count_positions(spliceSite3, window, start)
+            spliceSite5 = []
+            spliceSite3 = []
+    counts5 += count_positions(spliceSite5, window, start)
+    counts3 += count_positions(spliceSite3, window, start)
+    return counts5, counts3
+
+# Split an uncompressed FASTA into about parts byte ranges, each starting on a
+# record header, by moving evenly spaced offsets to the next "\n>"
+def record_ranges(fname, parts, scanSize=1<<16):
+    size = os.path.getsize(fname)
+    bounds = [0]
+    with open(fname, 'rb') as fileH:
+        for part in range(1, parts):
+            offset = max(size*part//parts, bounds[-1])
+            fileH.seek(offset)
+            boundary = size
+            tail = b''
+            while True:
+                block = fileH.read(scanSize)
+                if not block:
+                    break
+                found = (tail + block).find(b'\n>')
+                if found >= 0:
+                    boundary = offset - len(tail) + found + 1
+                    break
+                offset += len(block)
+                tail = block[-1:]
+            bounds.append(boundary)
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end]
+
+# Count one byte range of the input; run in the worker processes, which send
+# back only the two count matrices
+def count_range(start, end):
+    read_obj = FastAreader(inFile or '', useMmap=useMmap, start=start, end=end)
+    return count_splice_sites(read_obj.readFasta(), window, windowStart)
+
+# Letter heights in bits: each base's frequency times the position's
+# information content, 2 - entropy
+def letter_heights(counts):
+    freq = counts/np.maximum(counts.sum(axis=1, keepdims=True), 1)
+    logFreq = np.log2(freq, out=np.zeros(freq.shape), where=freq > 0)
+    entropy = -(freq*logFreq).sum(axis=1)
+    return freq*(2.0 - entropy)[:, np.newaxis]
+
+# Stack each position's letters from least to most frequent; returns the
+# position, base code, bottom and height of every letter with a height
+def stack_letters(heights):
+    order = np.argsort(heights, axis=1, kind="stable")
+    stacked = np.take_along_axis(heights, order, axis=1)
+    bottoms = np.zeros(stacked.shape)
+    np.cumsum(stacked[:, :-1], axis=1, out=bottoms[:, 1:])
+    positions = np.repeat(np.arange(len(heights)), 4).reshape(order.shape)
+    drawn = stacked > 0
+    return positions[drawn], order[drawn], bottoms[drawn], stacked[drawn]
+
+# Base outlines in bold type, scaled to fill the unit square; built once
+glyphPaths = {}
+def glyph_path(base):
+    if base not in glyphPaths:
+        path = TextPath((0, 0), base, size=1, prop=FontProperties(weight="bold"))
+        extents = path.get_extents()
+        vertices = (path.vertices - [extents.x0, extents.y0])/[extents.width, extents.height]
+        glyphPaths[base] = Path(vertices, path.codes)
+    return glyphPaths[base]
+
+# Draw a logo as one collection of letter outlines, each glyph stretched to
+# its cell
+def plot_logo(panel, heights):
+    letters = list(zip(*stack_letters(heights)))
+    if inLogos:
+        plot_logo_pngs(panel, letters)
+        return
+    paths = []
+    colors = []
+    for base, code, bottom, height in letters:
+        glyph = glyph_path(bases[code])
+        paths.append(Path(glyph.vertices*[1, height] + [base, bottom], glyph.codes))
+        colors.append(baseColors[code])
+    panel.add_collection(PathCollection(paths, facecolors=colors, linewidths=0,
+                                        transform=panel.transData), autolim=False)
+
+# Draw each letter as an image of its base PNG
+def plot_logo_pngs(panel, letters):
+    for base, code, bottom, height in letters:
+        panel.imshow(glyphImages[code], extent=[base, base+1, bottom, bottom+height], aspect="auto") 
+
+# Count fasta sequences by splice site, splitting uncompressed files across
+# worker processes, and sum the count matrices
+ranges = [(0, None)]
+if inFile and not inFile.endswith('.gz') and processes > 1 \
+        and 'fork' in multiprocessing.get_all_start_methods():
+    ranges = record_ranges(inFile, processes)
+if len(ranges) > 1:
+    with multiprocessing.get_context('fork').Pool(len(ranges)) as pool:
+        rangeCounts = pool.starmap(count_range, ranges, chunksize=1)
+else:
+    rangeCounts = [count_range(start, end) for start, end in ranges]
+counts5 = sum(counts[0] for counts in rangeCounts)
+counts3 = sum(counts[1] for counts in rangeCounts)
+
+# Plot both splice site logos
+plot_logo(panel1, letter_heights(counts5))
+plot_logo(panel2, letter_heights(counts3))
 
 # Axis limits
-panel1.set_xlim([0, 20])
-panel2.set_xlim([0, 20])
+panel1.set_xlim([0, window])
+panel2.set_xlim([0, window])
 panel1.set_ylim([0, 2])
 panel2.set_ylim([0, 2])
 
 # Axis tick labels
 warnings.filterwarnings("ignore")
-panel1.set_xticklabels(np.arange(-10, 11, 5))
-panel2.set_xticklabels(np.arange(-10, 11, 5))
+distances = np.arange(-(window//2 // 5)*5, window - window//2 + 1, 5)
+panel1.set_xticks(distances + window//2)
+panel2.set_xticks(distances + window//2)
+panel1.set_xticklabels(distances)
+panel2.set_xticklabels(distances)
 panel2.set_yticks([])
 
 # Plot and axis titles
@@ -7,6 +7,13 @@
 #   Program description:
 #   Program takes an input text file. The program was written to be run in the 
 #   command line, but could be slightly modified to be run in Jupyter notebook. 
+#   Categories with more than -n points are drawn from a reproducible sample
+#   spread evenly over their identity quantiles (-n 0 draws every point); the
+#   plotted/total counts are printed and medians always use all points.
+#   Read names are <movie>_<quality>_<...>_<coverage>... and the second column
+#   is identity. The parsed columns are cached in --cache_dir, keyed by the
+#   input's path, size and modification time, so replotting a file skips the
+#   parse; pass --cache_dir "" to disable.
 #
 #   Program execution:
 #   python3 /Users/carlosarevalo/Desktop/swarm_program.py \
@@ -22,12 +29,23 @@ import matplotlib.patches as mplpatches
 import numpy as np 
 import sys,random,math
 import argparse
+import tempfile
+import hashlib
+import shutil
+import re
+import os
 
 # argument parser and definitions
 parser = argparse.ArgumentParser()
 parser.add_argument("-i", "--input_file")
 parser.add_argument("-o", "--output_file")
 parser.add_argument("-s", "--style_sheet") 
+parser.add_argument("-n", "--max_points", type=int, default=1000,
+                    help="points drawn per coverage category; 0 draws all of them")
+parser.add_argument("--seed", type=int, default=0,
+                    help="seed for the per-category sample")
+parser.add_argument("-c", "--cache_dir", default=os.path.join(os.path.expanduser("~"), ".cache", "swarm"),
+                    help="directory for parsed input caches; empty string disables caching")
 
 # read input file and style sheet
 args = parser.parse_args()
@@ -35,6 +53,78 @@ style_sheet = args.style_sheet
 plt.style.use(args.style_sheet)
 inFile = args.input_file
 outFile = args.output_file
+maxPoints = args.max_points
+seed = args.seed
+cacheDir = args.cache_dir
+
+# Read name fields 1 (quality) and 3 (coverage) and the identity column
+readPattern = re.compile(r"^[^\t\n_]*_([^\t\n_]*)_[^\t\n_]*_([^\t\n_]*)[^\t\n]*\t([^\t\r\n]*)", re.M)
+readArrays = ["coverage", "identity", "quality"]
+cacheVersion = 1 # bump when read_subreads or readArrays change
+
+# Parse a column of number strings, falling back to one field at a time so a
+# malformed field becomes nan instead of failing the chunk
+def to_float(column):
+    try:
+        return column.astype(np.float64)
+    except ValueError:
+        values = np.full(len(column), np.nan)
+        for i in range(len(column)):
+            try:
+                values[i] = float(column[i])
+            except ValueError:
+                pass
+        return values
+
+# Parse the input chunkSize bytes of lines at a time into coverage (int8, with
+# 11 standing for >10), identity and quality (float32) arrays. Rows with
+# non-numeric fields or coverage below 1 are skipped
+def read_subreads(inFile, chunkSize=1<<26):
+    chunks = {name: [] for name in readArrays}
+    with open(inFile, "r") as lines:
+        while True:
+            block = lines.readlines(chunkSize)
+            if not block:
+                break
+            fields = np.array(readPattern.findall("".join(block)), dtype=str).reshape(-1, 3)
+            quality = to_float(fields[:, 0])
+            coverage = to_float(fields[:, 1])
+            identity = to_float(fields[:, 2])
+            keep = ~np.isnan(quality) & ~np.isnan(identity) & (coverage >= 1) & (coverage == np.floor(coverage))
+            chunks["coverage"].append(np.minimum(coverage[keep], 11).astype(np.int8))
+            chunks["identity"].append(identity[keep].astype(np.float32))
+            chunks["quality"].append(quality[keep].astype(np.float32))
+    dtypes = {"coverage": np.int8, "identity": np.float32, "quality": np.float32}
+    return {name: np.concatenate(chunks[name]) if chunks[name] else np.empty(0, dtype=dtypes[name])
+            for name in readArrays}
+
+# Cache directory for an input, keyed by cacheVersion and the input's path, size
+# and modification time
+def cache_path(inFile, cacheDir):
+    stat = os.stat(inFile)
+    key = "%d\t%s\t%d\t%d" % (cacheVersion, os.path.abspath(inFile), stat.st_size, stat.st_mtime_ns)
+    return os.path.join(cacheDir, hashlib.sha1(key.encode()).hexdigest())
+
+# Load parsed columns from the cache, parsing and writing the cache on a miss
+def load_subreads(inFile, cacheDir):
+    if not cacheDir:
+        return read_subreads(inFile)
+    cachePath = cache_path(inFile, cacheDir)
+    if os.path.isdir(cachePath):
+        return {name: np.load(os.path.join(cachePath, name + ".npy"), mmap_mode="r") for name in readArrays}
+
+    reads = read_subreads(inFile)
+    # The cache only appears once all of its columns are saved
+    os.makedirs(cacheDir, exist_ok=True)
+    tmpPath = tempfile.mkdtemp(dir=cacheDir)
+    for name in readArrays:
+        np.save(os.path.join(tmpPath, name + ".npy"), reads[name])
+    try:
+        os.rename(tmpPath, cachePath)
+    except OSError:
+        shutil.rmtree(tmpPath) # already cached by a concurrent run
+
+    return reads
 
 # define figure dimentions
 figureHeight=3
@@ -54,79 +144,69 @@ colors = ["#9EC9E2", "#D12959", "#CDE5D2", "#CF597E", "#FEB24C", \
 # swarm_panel
 swarm_panel = plt.axes([0.1, 0.2, relativePanelWidth, relativePanelHeight])
 
-# dictionaries and lists with conditions, identity values, samples and quality scores
-sub_element = {"1":[], "2":[], "3":[], "4":[], "5":[], "6":[], "7":[], "8":[], "9":[], "10":[], ">10":[]}
+# colors by condition
 colors_dict = {"1":["#9EC9E2"], "2":["#D12959"], "3":["#CDE5D2"], "4":["#CF597E"], \
                 "5":["#FEB24C"], "6":["#E9E29C"], "7":["#F2ACCA"], "8":["#6CB0D6"], \
                 "9":["dimgrey"], "10":["#F0746E"], ">10":["grey"]}
 
-quality_scores = []
-element_qualDict = {}
-sample_dict = {}
-
-# read data and except NA values
-with open(inFile, "r") as inFile: 
-    for line in inFile: 
-        try:
-            splitline = line.strip().split("\t")
-            lineElements = splitline[0].split("_") 
-            condition = lineElements[3] 
-            identity = float(splitline[1])
-            if int(condition) <= 10:
-                sub_element[condition].append(float(identity))
-            else: 
-                condition = ">10"
-                sub_element[condition].append(float(identity))
-            qualScore = float(splitline[0].split("_")[1]) # quality score
-            quality_scores.append(qualScore)
+# read data, skipping NA values, and split identities by coverage condition
+reads = load_subreads(inFile, cacheDir)
+sub_element = {}
+for coverage in range(1, 12):
+    condition = str(coverage) if coverage <= 10 else ">10"
+    sub_element[condition] = reads["identity"][reads["coverage"] == coverage]
 
-            try:
-                element_qualDict[condition].append((identity, qualScore))
-            except KeyError:
-                element_qualDict[condition] = [(identity, qualScore)]
-        except ValueError:
+# Beeswarm offsets, in inches, for points at heights yInches. Points are
+# placed in y order, each against the window of placed points less than one
+# diameter d below it; every neighbor blocks an open x interval half a chord
+# wide around it, and the point goes to the center or, if that is blocked, to
+# the nearer edge (left on ties) of the merged blocked interval covering it
+def swarm_offsets(yInches, d):
+    order = np.argsort(yInches, kind="stable")
+    ys = yInches[order]
+    xs = np.zeros(len(ys))
+    windowStarts = np.searchsorted(ys, ys - d, side="left")
+    for i in range(len(ys)):
+        lo = windowStarts[i]
+        if lo == i:
             continue
+        dy = ys[i] - ys[lo:i]
+        half = np.sqrt(np.maximum(d*d - dy*dy, 0))
+        starts = xs[lo:i] - half
+        ends = xs[lo:i] + half
+        byStart = np.argsort(starts, kind="stable")
+        starts = starts[byStart]
+        ends = np.maximum.accumulate(ends[byStart])
+        # merged intervals begin where a start is not covered by the ones before
+        first = np.flatnonzero(np.concatenate(([True], starts[1:] >= ends[:-1])))
+        last = np.concatenate((first[1:] - 1, [len(starts) - 1]))
+        covering = np.flatnonzero((starts[first] < 0) & (ends[last] > 0))
+        if len(covering):
+            left = starts[first[covering[0]]]
+            right = ends[last[covering[0]]]
+            xs[i] = left if -left <= right else right
+    offsets = np.empty(len(xs))
+    offsets[order] = xs
+    return offsets
 
-# swarm function
-def swarm_plot(identPoints, bin, pointSize):
-    placedPoints = [] 
+# Pick n of values, one at random from each of n equal-count strata of the
+# sorted values, so the sample follows the full distribution's quantiles
+def stratified_sample(values, n, rng):
+    values = np.sort(np.asarray(values, dtype=np.float64))
+    if n <= 0 or len(values) <= n:
+        return values
+    bounds = (np.arange(n + 1)*len(values))//n
+    picks = bounds[:-1] + (rng.random(n)*(bounds[1:] - bounds[:-1])).astype(int)
+    return values[picks]
+
+# swarm function: median is drawn as the bin's red line
+def swarm_plot(identPoints, bin, pointSize, median):
     d = pointSize/72 # point diameter 
-    for yPos in identPoints:
-        direction = 0
-        xPos = float(bin)
-        closePoints = []
-        placed = False
-        for point in placedPoints:
-            newPoint = point[1]*(panelHeight/25)
-            new_yPoint= yPos*(panelHeight/25)
-            if np.abs(newPoint-new_yPoint) <= d:
-                closePoints.append(point)
-        if len(closePoints)==0:
-            placedPoints.append((xPos, yPos))
-            continue
-        while placed == False:
-            dist_list = []
-            direction += 1
-            shift = d/5
-            for point in closePoints:
-                print(point)
-                dist = abs(xPos*(panelWidth/11.5)-point[0]*(panelWidth/11.5)) # distance
-                dist_list.append(dist)
-                # print(min(dist_list))
-            min_dist = min(dist_list) # defines minimal distance
-            if min_dist < d and direction % 2 == 0:
-                xPos = shift*(direction/2) + xPos
-            elif min_dist < d and direction % 2 == 1:
-                xPos = -(shift*(direction/2)) + xPos
-            elif min_dist > d:
-                placedPoints.append((xPos, yPos))
-                placed = True
-                xPos = float(bin)
-            pass
+    xPos = float(bin)
 
     # y and x values
-    xValue =[point[0] for point in placedPoints]
-    yValue =[point[1] for point in placedPoints]
+    yValue = np.asarray(identPoints, dtype=np.float64)
+    xValue = xPos + swarm_offsets(yValue*(panelHeight/25), d)/(panelWidth/11.5)
     # color by bins
     color_pos = int(bin)-1
     swarm_panel.plot(xValue, yValue, 
@@ -137,9 +217,9 @@ def swarm_plot(identPoints, bin, pointSize):
                     markeredgewidth = 0, 
                     linewidth = 0)
 
-    # add scatters
+    # add median line at the bin center
     swarm_panel.plot([xPos - panelWidth/12.5, xPos + panelWidth/12.5],
-        [np.median(yValue), np.median(yValue)], 
+        [median, median], 
         linewidth=1, color ="red")
 
 # add cutoff line at 95% identity
@@ -151,12 +231,17 @@ swarm_panel.tick_params(bottom=True, labelbottom=True,
                         right=False, labelright=False,
                         top=False, labeltop=False)
 
+rng = np.random.default_rng(seed)
 for key in sub_element.keys(): # keys are elements 1-11
-    subset = np.random.choice(sub_element[key], 1000)
+    if len(sub_element[key]) == 0:
+        continue
+    subset = stratified_sample(sub_element[key], maxPoints, rng)
+    median = np.median(sub_element[key])
+    print("coverage %s: %d/%d points plotted" % (key, len(subset), len(sub_element[key])))
     if key == ">10": 
-        swarm_plot(subset, "11", 0.6) 
+        swarm_plot(subset, "11", 0.6, median) 
     else: 
-        swarm_plot(subset, key, 0.6) 
+        swarm_plot(subset, key, 0.6, median) 
 
 # define ticks and axis labels:
 ticks = [x for x in range(1,11)]
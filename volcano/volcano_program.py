@@ -9,6 +9,14 @@
 #   column are the LFC values, and third column, p-values.
 #   The program was written to be executed in the command line and could be 
 #   slightly modified to Jupyter Notebook. 
+#   Genes with -log10(p) above --log_p are significant: those with LFC below
+#   --label_lfc are labeled, the rest with a fold change above --fold_change
+#   are drawn red. Rows with NA values are skipped. Only the --max_labels most
+#   significant labeled genes in view get a name, placed so names never overlap.
+#   Many contrasts are drawn in one run when -i is a directory or a quoted glob
+#   of such files, or a long table whose --contrast_column names the contrast
+#   of each row. Each contrast is saved as <output_file>/<contrast>.png by a
+#   pool of -p forked workers, each reusing one figure template.
 #
 #   Program execution:
 #   python3 /Users/carlosarevalo/Desktop/volcano_program.py \
@@ -16,19 +24,45 @@
 #       -o /Users/carlosarevalo/Downloads/volcano_test.png \
 #       -s /Users/carlosarevalo/Downloads/stylesheet.mplstyle 
 #
+#   python3 /Users/carlosarevalo/Desktop/volcano_program.py \
+#       -i /Users/carlosarevalo/Downloads/all_contrasts.txt --contrast_column 3 \
+#       -o /Users/carlosarevalo/Downloads/volcano_plots \
+#       -s /Users/carlosarevalo/Downloads/stylesheet.mplstyle 
+#
 ################################################################################
 
+import matplotlib
+matplotlib.use("Agg") # render contrasts headless, including in forked workers
 import matplotlib.pyplot as plt 
 import matplotlib.patches as mplpatches
+from matplotlib.font_manager import FontProperties
+from matplotlib.textpath import text_to_path
 import numpy as np 
+import multiprocessing
 import math
 import argparse
+import glob
+import os
 
 # Make instances of an argument parser and define arguments
 parser=argparse.ArgumentParser()
 parser.add_argument("-i", "--input_file")
 parser.add_argument("-o", "--output_file")
 parser.add_argument("-s", "--style_sheet") 
+parser.add_argument("--log_p", type=float, default=2,
+                    help="significant genes have -log10(p-value) above this")
+parser.add_argument("--label_lfc", type=float, default=6,
+                    help="significant genes with LFC below this are labeled")
+parser.add_argument("--fold_change", type=float, default=5,
+                    help="other significant genes with 2**|LFC| above this are drawn red")
+parser.add_argument("--max_labels", type=int, default=30,
+                    help="name at most this many of the most significant labeled genes")
+parser.add_argument("-t", "--title", default="EA (4:45 hrs)",
+                    help="panel title for a single input; contrasts are titled by name")
+parser.add_argument("-c", "--contrast_column", type=int,
+                    help="0-based column of a long input table naming each row's contrast")
+parser.add_argument("-p", "--processes", type=int, default=os.cpu_count() or 1,
+                    help="worker processes used to render several contrasts")
 
 # Read input file and style sheet
 args=parser.parse_args()
@@ -36,114 +70,226 @@ style_sheet = args.style_sheet
 plt.style.use(args.style_sheet)
 inFile = args.input_file
 outFile = args.output_file
+minLogP = args.log_p
+labelLfc = args.label_lfc
+minFoldChange = args.fold_change
+maxLabels = args.max_labels
+title = args.title
+contrastColumn = args.contrast_column
+processes = args.processes
+inFiles = sorted(glob.glob(inFile)) or [inFile]
+
+# Convert a column of strings to floats; NA and any other non-numeric field
+# become nan
+def to_float(column):
+    values = np.full(len(column), np.nan)
+    numeric = column != "NA"
+    try:
+        values[numeric] = column[numeric].astype(np.float64)
+    except ValueError:
+        for i in np.flatnonzero(numeric):
+            try:
+                values[i] = float(column[i])
+            except ValueError:
+                pass
+    return values
+
+# Read genes, LFC and -log10(p-value) arrays, dropping rows with NA values.
+# With contrastColumn, that column's contrast names are returned as well
+def read_results(inFile, contrastColumn=None):
+    columns = (0, 1, 2) if contrastColumn is None else (0, 1, 2, contrastColumn)
+    table = np.loadtxt(inFile, delimiter="\t", usecols=columns, dtype=str, ndmin=2)
+    lfc = to_float(table[:, 1])
+    pvalues = to_float(table[:, 2])
+    keep = ~np.isnan(lfc) & ~np.isnan(pvalues)
+    with np.errstate(divide="ignore"):
+        log_p = -np.log10(pvalues[keep])
+    if contrastColumn is None:
+        return table[keep, 0], lfc[keep], log_p
+    return table[keep, 0], lfc[keep], log_p, table[keep, 3]
+
+# Split genes into labeled, red and grey masks
+def classify(lfc, log_p, minLogP, labelLfc, minFoldChange):
+    significant = log_p > minLogP
+    labeled = significant & (lfc < labelLfc)
+    red = significant & ~labeled & (2**np.abs(lfc) > minFoldChange)
+    grey = ~labeled & ~red
+    return labeled, red, grey
+
+# Width of a label in inches, summed from character advances that are measured
+# once per character from the label font
+charWidths = {}
+def text_width(text, fontsize):
+    width = 0
+    for char in text:
+        if (char, fontsize) not in charWidths:
+            advance = text_to_path.get_text_width_height_descent(char, FontProperties(size=fontsize), ismath=False)[0]
+            charWidths[char, fontsize] = advance/72
+        width += charWidths[char, fontsize]
+    return width
+
+# Place labels next to their points without overlaps, in the given order. Label
+# boxes are measured in inches with text_width, widened by 10% for hinting at
+# low resolutions and padded by gap, and placed boxes are kept in a grid of
+# line-height cells, so each candidate position (above, right, left, below) is
+# only checked against boxes in the cells it covers. Labels that fit nowhere
+# inside the panel are skipped. Returns (x, y, text, ha, va) in data units
+def place_labels(x_vals, y_vals, texts, xlim, ylim, panelWidth, panelHeight, fontsize=4):
+    xScale = panelWidth/(xlim[1] - xlim[0])
+    yScale = panelHeight/(ylim[1] - ylim[0])
+    lineHeight = fontsize/72*1.2
+    gap = fontsize/72*0.3
+    cells = {}
+    placed = []
+    for x, y, text in zip(x_vals, y_vals, texts):
+        px = (x - xlim[0])*xScale
+        py = (y - ylim[0])*yScale
+        width = text_width(text, fontsize)*1.1 + gap
+        # text anchor and box lower left corner, in inches from the panel origin
+        candidates = [(px, py + gap, px - width/2, py + gap, "center", "bottom"),
+                      (px + gap, py, px + gap, py - lineHeight/2, "left", "center"),
+                      (px - gap, py, px - gap - width, py - lineHeight/2, "right", "center"),
+                      (px, py - gap, px - width/2, py - gap - lineHeight, "center", "top")]
+        for tx, ty, left, bottom, ha, va in candidates:
+            right = left + width
+            top = bottom + lineHeight
+            if left < 0 or bottom < 0 or right > panelWidth or top > panelHeight:
+                continue
+            keys = [(i, j) for i in range(int(left//lineHeight), int(right//lineHeight) + 1)
+                           for j in range(int(bottom//lineHeight), int(top//lineHeight) + 1)]
+            if any(left < box[2] and box[0] < right and bottom < box[3] and box[1] < top
+                   for key in keys for box in cells.get(key, ())):
+                continue
+            for key in keys:
+                cells.setdefault(key, []).append((left, bottom, right, top))
+            placed.append((xlim[0] + tx/xScale, ylim[0] + ty/yScale, text, ha, va))
+            break
+    return placed
+
+# Build the figure and panel once; draw_volcano only adds and removes data
+def build_template():
+
+    # Define figure dimensions:
+    figureHeight=4
+    figureWidth=4
+    figure=plt.figure(figsize=(figureWidth, figureHeight)) 
+
+    # Normalize axis units:
+    relativePanelWidth=panelWidth/figureWidth
+    relativePanelHeight=panelHeight/figureHeight
+    panel1=plt.axes([0.2, 0.2, relativePanelWidth, relativePanelHeight])
 
-# Make lists of input values:
-x_values = []
-y_values = []
-r_xvalues = []
-r_yvalues = []
-x_labels = []
-y_labels = []
-labels = []
-
-# Read data and except NA values: 
-with open(inFile, "r") as inFile:
-    for line in inFile.readlines():
-        try:
-            splitline = line.strip().split("\t")
-            genes = splitline[0]
-            x = float(splitline[1])
-            y = -1*np.log10(float(splitline[2]))
-            # Take absolute value of LFC
-            fold_change = 2**abs(x)
-            # Label all metabolites with p-value < 0.01
-            if x < 6 and fold_change > 0 and y > 2:
-                x_labels.append(x)
-                y_labels.append(y)
-                labels.append(genes)
-            elif fold_change > 5 and y > 2:
-                r_xvalues.append(x)
-                r_yvalues.append(y)
-            else:
-                x_values.append(x)
-                y_values.append(y)
-        except ValueError:
-            continue
-
-# add +0.3 and -0.3 to values in same y-value to avoid overlapping
-#noise_up = 0.3
-#noise_down = -0.3
-#y_label = []
-#for value in y_labels:
-#    value = value + noise_up
-#    y_label.append(value)
-#    if value in y_label:
-#        value = value+0.3
-#        y_label.append(value)
-        #print(value)
-
-# Define figure dimensions:
-figureHeight=4
-figureWidth=4
-plt.figure(figsize=(figureWidth, figureHeight)) 
+    # Axis labels:
+    panel1.tick_params(bottom=True, labelbottom=True,
+                       left=True, labelleft=True,
+                       right=False, labelright=False,
+                       top=False, labeltop=False)
+
+    # Panel axis and labels:
+    panel1.set_xlim(-8, 8)
+    panel1.set_ylim(0, 8) # max(y_values)+0.5)
+    panel1.set_xticks(np.arange(-8, 8.5, 2))
+    panel1.set_yticks(np.arange(0, 8.5, 1)) # max(y_values)+0.5, 1))
+    panel1.set_xlabel("$\mathregular{log_{2}}$(fold change)")
+    panel1.set_ylabel("-$\mathregular{log_{10}}$(p-value)")
+    return figure, panel1
+
+# Draw one set of results on the template and save it, then remove the points
+# and labels again so the next plot starts from the bare template
+def draw_volcano(figure, panel1, genes, lfc, log_p, title, outFile):
+
+    # Classify all genes at once:
+    labeled, red, grey = classify(lfc, log_p, minLogP, labelLfc, minFoldChange)
+    x_values, y_values = lfc[grey], log_p[grey]
+    r_xvalues, r_yvalues = lfc[red], log_p[red]
+    x_labels, y_labels = lfc[labeled], log_p[labeled]
+    labels = genes[labeled]
+    panel1.set_title(title, fontsize=8)
+
+    # Add scatters to panel:
+    artists = []
+    artists += panel1.plot(x_values, y_values,
+                           marker='o',
+                           markerfacecolor="#CCCCCC", #(0,0,0),
+                           markeredgecolor="#CCCCCC", #(0,0,0),
+                           markersize=2,
+                           markeredgewidth=0,
+                           linewidth=0)
+
+    artists += panel1.plot(r_xvalues, r_yvalues,
+                           marker='o',
+                           markerfacecolor="red",
+                           markeredgecolor="red",
+                           markersize=2, 
+                           markeredgewidth=0,
+                           linewidth=0)  
+
+    artists += panel1.plot(x_labels, y_labels,
+                           marker='o',
+                           markerfacecolor="red",
+                           markeredgecolor="red",
+                           markersize=2,
+                           markeredgewidth=0,
+                           linewidth=0) 
+
+    # Add labels to the most significant labeled genes in view:
+    xlim, ylim = panel1.get_xlim(), panel1.get_ylim()
+    inView = (x_labels >= xlim[0]) & (x_labels <= xlim[1]) & (y_labels >= ylim[0]) & (y_labels <= ylim[1])
+    order = np.flatnonzero(inView)[np.argsort(-y_labels[inView], kind="stable")][:maxLabels]
+    for x, y, text, ha, va in place_labels(x_labels[order], y_labels[order], labels[order],
+                                           xlim, ylim, panelWidth, panelHeight):
+        artists.append(panel1.text(x, y, text,
+                                   fontsize=4,
+                                   verticalalignment=va,
+                                   horizontalalignment=ha))
+
+    # Save figure
+    figure.savefig(outFile, dpi=600)
+    for artist in artists:
+        artist.remove()
+
+# Render contrasts[index] to <output_file>/<contrast>.png; each process builds
+# its template on first use
+template = None
+def render_contrast(index):
+    global template
+    if template is None:
+        template = build_template()
+    name, genes, lfc, log_p = contrasts[index]
+    fileName = name.replace(os.sep, "_") + ".png"
+    draw_volcano(*template, genes, lfc, log_p, name, os.path.join(outFile, fileName))
 
 # Panels size parameters
 panelWidth=2.0
 panelHeight=2.0
 
-# Normalize axis units:
-relativePanelWidth=panelWidth/figureWidth
-relativePanelHeight=panelHeight/figureHeight
-panel1=plt.axes([0.2, 0.2, relativePanelWidth, relativePanelHeight])
-
-# Axis labels:
-panel1.tick_params(bottom=True, labelbottom=True,
-                   left=True, labelleft=True,
-                   right=False, labelright=False,
-                   top=False, labeltop=False)
-
-# Panel axis and labels:
-panel1.set_xlim(-8, 8)
-panel1.set_ylim(0, 8) # max(y_values)+0.5)
-panel1.set_xticks(np.arange(-8, 8.5, 2))
-panel1.set_yticks(np.arange(0, 8.5, 1)) # max(y_values)+0.5, 1))
-panel1.set_xlabel("$\mathregular{log_{2}}$(fold change)")
-panel1.set_ylabel("-$\mathregular{log_{10}}$(p-value)")
-panel1.set_title("EA (4:45 hrs)", fontsize=8)
-
-# Add scatters to panel:
-panel1.plot(x_values, y_values,
-            marker='o',
-            markerfacecolor="#CCCCCC", #(0,0,0),
-            markeredgecolor="#CCCCCC", #(0,0,0),
-            markersize=2,
-            markeredgewidth=0,
-            linewidth=0)
-
-panel1.plot(r_xvalues, r_yvalues,
-            marker='o',
-            markerfacecolor="red",
-            markeredgecolor="red",
-            markersize=2, 
-            markeredgewidth=0,
-            linewidth=0)  
-
-panel1.plot(x_labels, y_labels,
-            marker='o',
-            markerfacecolor="red",
-            markeredgecolor="red",
-            markersize=2,
-            markeredgewidth=0,
-            linewidth=0) 
-
-# Add labels to scatter:
-for i in range(len(labels)):
-    x=x_labels[i]
-    y=y_label[i]
-    panel1.annotate(labels[i],(x, y),
-                    xytext=(x-0.25, y),
-                    fontsize=4,
-                    verticalalignment="bottom",
-                    horizontalalignment="center") 
-# Save figure
-plt.savefig(outFile, dpi=600)
+# Read every contrast once: (name, genes, lfc, log_p)
+contrasts = []
+if contrastColumn is not None:
+    genes, lfc, log_p, names = read_results(inFiles[0], contrastColumn)
+    contrastNames, first, inverse = np.unique(names, return_index=True, return_inverse=True)
+    groups = np.split(np.argsort(inverse, kind="stable"), np.cumsum(np.bincount(inverse))[:-1])
+    for index in np.argsort(first):
+        group = groups[index]
+        contrasts.append((contrastNames[index], genes[group], lfc[group], log_p[group]))
+elif os.path.isdir(inFile) or len(inFiles) > 1:
+    if os.path.isdir(inFile):
+        paths = sorted(os.path.join(inFile, name) for name in os.listdir(inFile)
+                       if not name.startswith(".") and os.path.isfile(os.path.join(inFile, name)))
+    else:
+        paths = inFiles
+    for path in paths:
+        contrasts.append((os.path.splitext(os.path.basename(path))[0],) + read_results(path))
+
+# Render a single input to output_file, or every contrast into output_file
+if not contrasts:
+    genes, lfc, log_p = read_results(inFiles[0])
+    draw_volcano(*build_template(), genes, lfc, log_p, title, outFile)
+else:
+    os.makedirs(outFile, exist_ok=True)
+    if len(contrasts) > 1 and processes > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        with multiprocessing.get_context('fork').Pool(min(processes, len(contrasts))) as pool:
+            pool.map(render_contrast, range(len(contrasts)), chunksize=1)
+    else:
+        for index in range(len(contrasts)):
+            render_contrast(index)